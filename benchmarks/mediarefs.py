@@ -0,0 +1,93 @@
+"""Checks and times the media reference scan on random cells.
+
+    python benchmarks/mediarefs.py --cases 2000 --seed 1
+
+util.getMediaRefs searches all cells of a column joined into one string.
+Every case is compared with _getMediaRefsByCell, which searches the cells
+one by one, and the run fails when the two disagree.  The time both take
+for all cases is reported, and for a column of mostly plain text, which
+is what the joined search is for.
+"""
+import argparse
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import ankidmpy.util as util
+
+MEDIA = ['a.mp3', 'x.png', 'b c.ogg', 'd&e.jpg', 'f%20g.png']
+
+# Pieces of cells, complete and broken references among them.
+PIECES = [
+    'text', ' ', '[sound:', ']', '<img src="', '">', '<img src=', '>',
+    "<audio src='", "'>", 'url(', ')', '"', "'", '<', '[', '(', '&amp;',
+    '%20', 'url("', '")', '<video class=v src=', '[sound:a.mp3]', '\0'
+] + MEDIA
+
+
+def randomCells(rnd):
+    return [
+        ''.join(rnd.choice(PIECES) for _ in range(rnd.randint(0, 8)))
+        for _ in range(rnd.randint(0, rnd.choice((5, 200))))
+    ]
+
+
+def textColumn(rows=200000):
+    # One cell in ten references an image.
+    return [
+        'w<img src="%s">' % (MEDIA[1],) if i % 10 == 0 else
+        'word %d back "é" text' % (i,) for i in range(rows)
+    ]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Check the media reference scan against a plain one.')
+    parser.add_argument('--cases', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    rnd = random.Random(args.seed)
+    media_index = dict.fromkeys(MEDIA)
+    cases = [randomCells(rnd) for _ in range(args.cases)]
+
+    joined, joined_time = timed(
+        lambda: [util.getMediaRefs(cells, media_index) for cells in cases])
+    by_cell, by_cell_time = timed(lambda: [
+        util._getMediaRefsByCell(cells, media_index) for cells in cases
+    ])
+    column = textColumn()
+    column_refs, column_time = timed(util.getMediaRefs, column, media_index)
+    column_by_cell, column_by_cell_time = timed(util._getMediaRefsByCell,
+                                                column, media_index)
+    joined.append(column_refs)
+    by_cell.append(column_by_cell)
+    cases.append(column)
+
+    failed = 0
+    for cells, a, b in zip(cases, joined, by_cell):
+        if a != b:
+            if failed < 5:
+                print('%r: %r != %r' % (cells, a, b))
+            failed += 1
+    print('%d of %d cases disagree' % (failed, len(cases)))
+    print('                random   text column')
+    print('joined  %8.3fs %8.3fs' % (joined_time, column_time))
+    print('by cell %8.3fs %8.3fs' % (by_cell_time, column_by_cell_time))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+"""Times build, import, index and copy on synthetic deck sets.
+
+    python benchmarks/run.py --scales small,medium --output results.json
+    python benchmarks/run.py --compare old.json new.json
+
+Every measurement runs in its own child process.  Wall and CPU time are
+the best of --repeat runs; peak memory is measured in a separate run
+with tracemalloc enabled so that it doesn't skew the timings.
+"""
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os.path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import ankidmpy.builder as builder
+import ankidmpy.copier as copier
+import ankidmpy.importer as importer
+import ankidmpy.indexer as indexer
+import ankidmpy.sourcecache as sourcecache
+import ankidmpy.util as util
+
+import synthetic
+
+SCALES = {
+    'small': dict(rows=1000, fields=4, languages=('fr',), decks=2, media=50),
+    'medium': dict(rows=20000,
+                   fields=6,
+                   languages=('fr', 'de'),
+                   decks=4,
+                   media=500),
+    'large': dict(rows=100000,
+                  fields=8,
+                  languages=('fr', 'de', 'es'),
+                  decks=8,
+                  media=2000),
+}
+
+BUILD_ALL_SETS = 4
+
+
+def _setupBuild(src, work):
+    sourcecache.setEnabled(False)
+    return (builder.build, ([], src, os.path.join(work, 'build'), None),
+            dict(force=True))
+
+
+def _setupBuildDeck(src, work):
+    # One deck in one language, which only needs some of the columns.
+    sourcecache.setEnabled(False)
+    return (builder.build, (['Deck 2'], src, os.path.join(work, 'build'),
+                            'fr'), dict(force=True))
+
+
+def _setupSerialize(src, work):
+    # The same decks as 'build', serialized in memory.
+    sourcecache.setEnabled(False)
+
+    def serialize():
+        deck_set = builder.DeckSet(src)
+        for deck, lang in deck_set.outputs():
+            for _ in deck_set.serialize(deck, lang):
+                pass
+
+    return (serialize, (), dict())
+
+
+def _setupCachedBuild(src, work):
+    # The warm-up loads the same columns as the timed build, which are
+    # cached under their projection.
+    with contextlib.redirect_stdout(io.StringIO()):
+        builder.build([], src, os.path.join(work, 'warm'), None)
+    return (builder.build, ([], src, os.path.join(work, 'build'), None),
+            dict(force=True))
+
+
+def _setupBuildAll(src, work):
+    # Deck sets made of links to the sources of the synthetic one.
+    sourcecache.setEnabled(False)
+    sets = []
+    for i in range(BUILD_ALL_SETS):
+        sets.append(os.path.join(work, 'set-%d' % (i,)))
+        os.mkdir(sets[-1])
+        for fn in os.listdir(src):
+            os.symlink(os.path.join(src, fn), os.path.join(sets[-1], fn))
+    return (builder.buildAll, (sets, os.path.join(work, 'build')),
+            dict(force=True, jobs=multiprocessing.cpu_count()))
+
+
+def _setupImport(src, work):
+    build_dir = os.path.join(work, 'build')
+    with contextlib.redirect_stdout(io.StringIO()):
+        builder.build(['Deck 1'], src, build_dir, 'default')
+    target = os.path.join(work, 'imported')
+    os.mkdir(target)
+    return (importer.importIt, (os.path.join(
+        build_dir, util.deckToFilename('Deck 1')), target), dict())
+
+
+def _setupIndex(src, work):
+    base = os.path.join(work, 'index')
+    os.mkdir(base)
+    shutil.copy(os.path.join(src, 'data.csv'), os.path.join(base, 'data.csv'))
+    return (indexer.indexIt, (True, base), dict())
+
+
+def _setupCopy(src, work):
+    base = os.path.join(work, 'copy')
+    shutil.copytree(os.path.join(src, 'decks'), os.path.join(base, 'decks'))
+    return (copier.copy, ('Deck 1', None, base), dict())
+
+
+def _setupLoad(src, work):
+    return (util.getCsv, (os.path.join(src, 'data.csv'),), dict())
+
+
+CASES = {
+    'load': _setupLoad,
+    'build': _setupBuild,
+    'build-deck': _setupBuildDeck,
+    'serialize': _setupSerialize,
+    'build-cached': _setupCachedBuild,
+    'build-all': _setupBuildAll,
+    'import': _setupImport,
+    'index': _setupIndex,
+    'copy': _setupCopy,
+}
+
+
+def _measure(case, src, memory, json_backend, results):
+    work = tempfile.mkdtemp(prefix='anki-dm-bench-')
+    result = dict()
+    try:
+        util.setJsonBackend(json_backend)
+        func, args, kwargs = CASES[case](src, work)
+        if memory:
+            tracemalloc.start()
+        wall, cpu = time.perf_counter(), time.process_time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func(*args, **kwargs)
+        result = dict(wall=time.perf_counter() - wall,
+                      cpu=time.process_time() - cpu)
+        if memory:
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    except Exception as e:
+        result = dict(error='%s: %s' % (type(e).__name__, e))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+        results.put(result)
+
+
+def measure(case, src, memory=False, json_backend=None):
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_measure,
+                                    args=(case, src, memory, json_backend,
+                                          results))
+    child.start()
+    result = results.get()
+    child.join()
+    if 'error' in result:
+        util.err("Benchmark '%s' failed: %s" % (case, result['error']))
+    return result
+
+
+def run(scales, cases, repeat, json_backend=None):
+    report = dict(python=platform.python_version(),
+                  platform=platform.platform(),
+                  time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  json_backend=util.setJsonBackend(json_backend),
+                  results=[])
+    for scale in scales:
+        src = tempfile.mkdtemp(prefix='anki-dm-bench-src-')
+        try:
+            synthetic.generate(src, **SCALES[scale])
+            for case in cases:
+                runs = [
+                    measure(case, src, json_backend=json_backend)
+                    for _ in range(repeat)
+                ]
+                result = dict(scale=scale,
+                              case=case,
+                              wall=min(r['wall'] for r in runs),
+                              cpu=min(r['cpu'] for r in runs),
+                              peak_memory=measure(
+                                  case,
+                                  src,
+                                  memory=True,
+                                  json_backend=json_backend)['peak_memory'])
+                report['results'].append(result)
+                util.warn('%-8s %-12s wall %8.3fs  cpu %8.3fs  peak %10.1f KiB'
+                          % (scale, case, result['wall'], result['cpu'],
+                             result['peak_memory'] / 1024.0))
+        finally:
+            shutil.rmtree(src, ignore_errors=True)
+    return report
+
+
+def compare(old_fn, new_fn):
+    old = dict(((r['scale'], r['case']), r)
+               for r in util.getJson(old_fn)['results'])
+    for r in util.getJson(new_fn)['results']:
+        before = old.get((r['scale'], r['case']))
+        if not before:
+            continue
+        util.msg('%-8s %-12s wall x%.2f  cpu x%.2f  peak x%.2f' %
+                 (r['scale'], r['case'], r['wall'] / before['wall'],
+                  r['cpu'] / before['cpu'],
+                  r['peak_memory'] / float(before['peak_memory'])))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark anki-dm.')
+    parser.add_argument('--scales',
+                        default='small',
+                        help='Comma separated scales: %s.  [Default: small]' %
+                        (', '.join(SCALES),))
+    parser.add_argument('--cases',
+                        default=','.join(CASES),
+                        help='Comma separated cases.  [Default: all]')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Write the results to a JSON file.')
+    parser.add_argument('--json-backend',
+                        choices=util.JSON_BACKENDS,
+                        help='''JSON encoder to use.  [Default: the fastest
+                        one installed]''')
+    parser.add_argument('--compare',
+                        nargs=2,
+                        metavar=('OLD', 'NEW'),
+                        help='Compare two result files.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args.scales.split(','), args.cases.split(','), args.repeat,
+                 args.json_backend)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(util.toJson(report))
+    else:
+        util.msg(util.toJson(report))
+
+
+if __name__ == '__main__':
+    main()
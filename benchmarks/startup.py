@@ -0,0 +1,102 @@
+"""Times the start-up of the anki-dm command line.
+
+    python benchmarks/startup.py --repeat 20 --max-overhead 0.05
+
+Each command runs in a fresh interpreter and the overhead over a bare
+'python -c pass' is reported.  The run fails when a command is slower than
+--max-overhead seconds or when '--help' loads modules that only the
+sub-commands need.
+"""
+import argparse
+import os.path
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+COMMANDS = {
+    'help': ['-m', 'ankidmpy', '--help'],
+    'templates': ['-m', 'ankidmpy', '--templates'],
+    'bad-args': ['-m', 'ankidmpy', 'build', '--jobs', 'many'],
+}
+
+# Modules that '--help' must not import.
+LAZY_MODULES = ('ankidmpy.builder', 'ankidmpy.copier', 'ankidmpy.importer',
+                'ankidmpy.indexer', 'ankidmpy.watcher', 'ankidmpy.sourcecache',
+                'ankidmpy.notestore', 'ankidmpy.selection', 'ankidmpy.util')
+
+LOADED_MODULES = """
+import sys
+sys.argv = ['anki-dm', '--help']
+try:
+    import ankidmpy.runner
+    ankidmpy.runner.main()
+except SystemExit:
+    pass
+sys.stderr.write(' '.join(sorted(sys.modules)))
+"""
+
+
+def _environment():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [SRC_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+
+def timeCommand(args, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args,
+                       env=_environment(),
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def loadedModules():
+    result = subprocess.run([sys.executable, '-c', LOADED_MODULES],
+                            env=_environment(),
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True,
+                            check=True)
+    return set(result.stderr.split())
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the start-up of anki-dm.')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--max-overhead',
+                        type=float,
+                        help='''Fail when a command takes longer than this
+                        many seconds over a bare interpreter.''')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    failed = False
+
+    eager = sorted(loadedModules().intersection(LAZY_MODULES))
+    if eager:
+        print("'--help' imports %s" % (', '.join(eager),))
+        failed = True
+
+    baseline = timeCommand(['-c', 'pass'], args.repeat)
+    print('%-10s %8.1f ms' % ('python', baseline * 1000))
+    for name, command in COMMANDS.items():
+        overhead = timeCommand(command, args.repeat) - baseline
+        print('%-10s %+8.1f ms' % (name, overhead * 1000))
+        if args.max_overhead is not None and overhead > args.max_overhead:
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Generates synthetic deck sets in the layout written by 'anki-dm import'.
+
+    python benchmarks/synthetic.py OUTPUT_DIR --rows 10000 --languages fr,de
+"""
+import argparse
+import csv
+import os.path
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import ankidmpy.util as util
+
+WORDS = ('alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf',
+         'hotel', 'india', 'juliett', 'kilo', 'lima', 'mike', 'november',
+         'oscar', 'papa', 'québec', 'romeo', 'sierra', 'tango', 'uniform',
+         'victor', 'whiskey', 'x-ray', 'yankee', 'zulu')
+
+
+def generate(directory,
+             rows=1000,
+             fields=4,
+             languages=(),
+             decks=1,
+             templates=2,
+             media=50,
+             media_size=4096,
+             seed=0):
+    rnd = random.Random(seed)
+    random.seed(seed)
+    util.prepareDir(directory)
+
+    def write(fn, contents):
+        with open(os.path.join(directory, fn), 'w') as f:
+            f.write(contents)
+
+    write('deck.json',
+          util.toJson(dict(dyn=0, extendNew=10, extendRev=50, children=[])))
+    write(
+        'config.json',
+        util.toJson(
+            dict(autoplay=True,
+                 dyn=False,
+                 lapse=dict(delays=[10],
+                            leechAction=0,
+                            leechFails=8,
+                            minInt=1,
+                            mult=0),
+                 maxTaken=60,
+                 new=dict(bury=False,
+                          delays=[1, 10],
+                          initialFactor=2500,
+                          ints=[1, 4, 7],
+                          order=1,
+                          perDay=20,
+                          separate=True),
+                 replayq=True,
+                 rev=dict(bury=False,
+                          ease4=1.3,
+                          fuzz=0.05,
+                          ivlFct=1,
+                          maxIvl=36500,
+                          minSpace=1,
+                          perDay=200),
+                 timer=0)))
+    write(
+        'model.json',
+        util.toJson(
+            dict(latexPost='\\end{document}',
+                 latexPre='\\documentclass[12pt]{article}\n',
+                 type=0,
+                 vers=[])))
+    write('desc.html', 'Synthetic deck set with %d rows.' % (rows,))
+    write('style.css', '.card {\n font-family: arial;\n}\n')
+
+    field_names = ['Field %d' % (i + 1,) for i in range(fields)]
+
+    util.prepareDir(os.path.join(directory, 'templates'))
+    template_names = []
+    for i in range(templates):
+        name = 'Card %d' % (i + 1,)
+        front = field_names[i % fields]
+        back = field_names[(i + 1) % fields]
+        write(os.path.join('templates', name + '.html'),
+              '{{%s}}\n\n--\n\n{{FrontSide}}\n\n<hr id=answer>\n\n{{%s}}' %
+              (front, back))
+        template_names.append(name)
+
+    util.prepareDir(os.path.join(directory, 'media'))
+    media_files = []
+    for i in range(media):
+        name = 'media-%05d.%s' % (i, 'mp3' if i % 2 else 'png')
+        with open(os.path.join(directory, 'media', name), 'wb') as f:
+            f.write(rnd.getrandbits(8 * media_size).to_bytes(
+                media_size, 'little'))
+        media_files.append(name)
+
+    header = ['guid'] + field_names + ['tags']
+    for lang in languages:
+        header += ['%s:%s' % (field, lang) for field in field_names]
+    guids = set()
+    with open(os.path.join(directory, 'data.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for row in range(rows):
+            guid = util.createGuid()
+            while guid in guids:
+                guid = util.createGuid()
+            guids.add(guid)
+            cells = [
+                _cell(rnd, media_files)
+                for _ in range(fields * (1 + len(languages)))
+            ]
+            tags = ' '.join(rnd.sample(WORDS[:8], rnd.randint(0, 3)))
+            writer.writerow([guid] + cells[:fields] + [tags] + cells[fields:])
+
+    for i in range(decks):
+        name = 'Deck %d' % (i + 1,)
+        deck_dir = os.path.join(directory, 'decks', util.deckToFilename(name))
+        util.prepareDir(deck_dir)
+        deck_fields = field_names[:max(1, fields - i % fields)]
+        with open(os.path.join(deck_dir, 'build.json'), 'w') as f:
+            f.write(
+                util.toJson(
+                    dict(deck=dict(uuid=util.createUuid()),
+                         config=dict(uuid=util.createUuid(), name='Default'),
+                         model=dict(uuid=util.createUuid(), name='Basic'),
+                         fields=deck_fields,
+                         templates=template_names)))
+
+    return directory
+
+
+def _cell(rnd, media_files):
+    text = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 8)))
+    if media_files and rnd.random() < 0.1:
+        text += '[sound:%s]' % (rnd.choice(media_files),)
+    elif media_files and rnd.random() < 0.1:
+        text += '<img src="%s">' % (rnd.choice(media_files),)
+    return text
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic anki-dm deck set.')
+    parser.add_argument('directory', help='Directory to create.')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--fields', type=int, default=4)
+    parser.add_argument('--languages',
+                        default='',
+                        help='Comma separated language codes.')
+    parser.add_argument('--decks', type=int, default=1)
+    parser.add_argument('--templates', type=int, default=2)
+    parser.add_argument('--media', type=int, default=50)
+    parser.add_argument('--media-size', type=int, default=4096)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    generate(args.directory, args.rows, args.fields,
+             [lang for lang in args.languages.split(',') if lang], args.decks,
+             args.templates, args.media, args.media_size, args.seed)
+
+
+if __name__ == '__main__':
+    main()
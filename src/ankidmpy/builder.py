@@ -1,168 +1,1125 @@
+import ankidmpy.notestore as notestore
+import ankidmpy.selection as selection
+import ankidmpy.sourcecache as sourcecache
 import ankidmpy.util as util
-from collections import defaultdict
-import shutil
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import glob
 import os.path
+import queue
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
 
 
-def build(decks, src_dir, build_dir, lang):
-    glbals = dict(deck=util.getJson(os.path.join(src_dir, 'deck.json')),
-                  config=util.getJson(os.path.join(src_dir, 'config.json')),
-                  model=util.getJson(os.path.join(src_dir, 'model.json')),
-                  media=util.getFilesList(os.path.join(src_dir, 'media')),
-                  templates=util.getTemplates(os.path.join(
-                      src_dir, 'templates')),
-                  desc=util.getRaw(os.path.join(src_dir, 'desc.html')),
-                  css=util.getRaw(os.path.join(src_dir, 'style.css')),
-                  data=util.getCsv(os.path.join(src_dir, 'data.csv')))
+MANIFEST_FILE = '.anki-dm-manifest.json'
+MANIFEST_VERSION = 1
+MEDIA_STORE_DIR = '.media'
+IO_THREADS = 4
+IO_QUEUE_DEPTH = 8
+JSON_CHUNK_SIZE = 1 << 20
+MEDIA_BATCH_SIZE = 64
+ARCHIVE_FORMATS = {'zip': '.zip', 'tar.gz': '.tar.gz'}
+ARCHIVE_SPOOL_SIZE = 64 << 20
+SOURCE_GROUPS = ('json', 'media', 'templates', 'data')
 
+
+def build(decks,
+          src_dir,
+          build_dir,
+          lang,
+          jobs=1,
+          force=False,
+          media_mode='copy',
+          media_store=False,
+          io_threads=IO_THREADS,
+          io_queue=IO_QUEUE_DEPTH,
+          archive=None,
+          where=None,
+          compact=False):
+    # 'where' is a row selection expression, see the selection module.
+    DeckSet(src_dir, decks, lang, where,
+            cache='write').write(build_dir or 'build',
+                                 jobs=jobs,
+                                 force=force,
+                                 media_mode=media_mode,
+                                 media_store=media_store,
+                                 io_threads=io_threads,
+                                 io_queue=io_queue,
+                                 archive=archive,
+                                 compact=compact)
+
+
+class DeckSet:
+    # A deck set loaded into memory once, from which decks are built on
+    # demand without writing anything: as documents, the dicts a build
+    # writes as JSON, or as that JSON itself.  Only the sources of 'decks'
+    # in 'lang' are loaded, all of them by default, and 'where' selects the
+    # notes like it does for build.  'cache' is the sourcecache mode; by
+    # default the deck set neither reads nor writes .anki-dm-cache, which
+    # may not be writable for a service.
+
+    def __init__(self, src_dir, decks=None, lang=None, where=None,
+                 cache='off'):
+        self.src_dir = src_dir
+        self._decks = decks
+        self._lang = lang
+        self._where = selection.parse(where) if where else None
+        self._source_cache = cache
+        self._cache = dict()
+        self._glbals = None
+        self._project = None
+        self.reload()
+
+    def reload(self, groups=SOURCE_GROUPS + ('decks',)):
+        # Reads the sources in 'groups' again after they've changed, the
+        # groups of SOURCE_GROUPS and 'decks' for the build.json files, and
+        # plans the decks again.  The notes are also read again when the
+        # decks need other columns.
+        if 'decks' in groups:
+            self._cache.pop('decks', None)
+        project = _projectDecks(self._decks, self.src_dir, self._lang,
+                                self._where, self._cache)
+        if self._glbals is None:
+            groups = SOURCE_GROUPS
+        elif project != self._project:
+            groups = tuple(groups) + ('data',)
+        groups = [group for group in SOURCE_GROUPS if group in groups]
+        if groups:
+            self._glbals = _readGlobals(self.src_dir,
+                                        self._glbals,
+                                        groups,
+                                        where=self._where,
+                                        project=project,
+                                        source_cache=self._source_cache)
+            self._project = project
+        if 'data' in groups:
+            for key in ('media', 'hashes', 'guids'):
+                self._cache.pop(key, None)
+        self._outputs = _planOutputs(self._glbals, self._decks, self.src_dir,
+                                     self._lang, self._cache)
+
+    def outputs(self):
+        # The decks and languages that can be built, as (deck, lang) pairs.
+        return [(output['deck'], output['lang']) for output in self._outputs]
+
+    def document(self, deck, lang='default'):
+        # The deck JSON as a dict, notes included.  It doesn't share any
+        # values with the deck set, so it can be modified.
+        deck_data, notes = _deckDocument(self._glbals,
+                                         self._output(deck, lang))
+        deck_data = copy.deepcopy(deck_data)
+        deck_data['notes'] = list(notes)
+        return deck_data
+
+    def serialize(self, deck, lang='default', compact=False):
+        # Yields the deck JSON, the same text build writes, encoded as UTF-8
+        # in chunks of about JSON_CHUNK_SIZE characters.
+        deck_data, notes = _deckDocument(self._glbals,
+                                         self._output(deck, lang))
+        buffer, size = [], 0
+        for text in util.iterJsonStream(deck_data, 'notes', notes, compact):
+            buffer.append(text)
+            size += len(text)
+            if size >= JSON_CHUNK_SIZE:
+                yield ''.join(buffer).encode('utf-8')
+                buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer).encode('utf-8')
+
+    def media(self, deck, lang='default'):
+        # The paths of the media files the deck references.
+        return [
+            os.path.join(self.src_dir, 'media', media_file)
+            for media_file in self._output(deck, lang)['media']
+        ]
+
+    def write(self,
+              build_dir,
+              jobs=1,
+              force=False,
+              media_mode='copy',
+              media_store=False,
+              io_threads=IO_THREADS,
+              io_queue=IO_QUEUE_DEPTH,
+              archive=None,
+              compact=False,
+              verbose=True):
+        # Builds all decks into build_dir, like the 'build' command.  Returns
+        # the (deck, lang) pairs that weren't up to date.
+        pending = _buildOutputs(self._glbals,
+                                self._outputs,
+                                self.src_dir,
+                                build_dir,
+                                jobs=jobs,
+                                force=force,
+                                media_mode=media_mode,
+                                media_store=media_store,
+                                io_threads=io_threads,
+                                io_queue=io_queue,
+                                archive=archive,
+                                compact=compact,
+                                cache=self._cache,
+                                verbose=verbose)
+        return [(output['deck'], output['lang']) for output in pending]
+
+    def _output(self, deck, lang):
+        deck = util.deckToFilename(deck)
+        for output in self._outputs:
+            if output['deck'] == deck and output['lang'] == lang:
+                return output
+        util.err("Deck not found: %s (Language: %s)" % (deck, lang))
+
+
+def buildAll(src_dirs,
+             build_dir=None,
+             lang=None,
+             jobs=1,
+             force=False,
+             media_mode='copy',
+             media_store=False,
+             io_threads=IO_THREADS,
+             io_queue=IO_QUEUE_DEPTH,
+             archive=None,
+             where=None,
+             compact=False):
+    # Builds all decks of several deck sets, each into a directory under
+    # build_dir named after the deck set.  src_dirs may contain glob
+    # patterns.  The outputs of every set share one pool of worker
+    # processes, and a set that fails to build doesn't stop the others.
+    # Returns a summary of the run.
+    if archive and media_store:
+        util.err("A media store can't be used when building archives.")
+    build_dir = build_dir or 'build'
+    deck_sets = _deckSets(src_dirs, build_dir)
+    summary = dict(sets=len(deck_sets), built=0, up_to_date=0, failed=[])
+    options = dict(lang=lang,
+                   force=force,
+                   media_mode=media_mode,
+                   media_store=media_store,
+                   archive=archive,
+                   compact=compact,
+                   where=selection.parse(where) if where else None)
+    # Parsed templates are shared between the deck sets.
+    cache = dict()
+
+    if jobs > 1:
+        _buildSetsParallel(deck_sets, cache, summary, options, jobs,
+                           io_threads, io_queue)
+    else:
+        for src_dir, set_build_dir in deck_sets:
+            try:
+                glbals, _, manifest, pending = _planSet(
+                    src_dir, set_build_dir, cache, summary, options)
+                util.msg("Deck set: %s" % (src_dir,))
+                _recordOutputs(
+                    set_build_dir, manifest,
+                    _countBuilt(
+                        summary,
+                        _buildSerial(glbals, pending, set_build_dir,
+                                     media_mode, io_threads, io_queue)))
+            except (RuntimeError, ValueError, OSError) as e:
+                _setFailed(summary, src_dir, e)
+
+    util.msg(
+        "Built %d decks from %d deck sets, %d decks were up to date." %
+        (summary['built'], summary['sets'] - len(summary['failed']),
+         summary['up_to_date']))
+    if summary['failed']:
+        util.warn("%d of %d deck sets failed to build:" %
+                  (len(summary['failed']), summary['sets']))
+        for src_dir, _ in summary['failed']:
+            util.warn("  %s" % (src_dir,))
+    return summary
+
+
+def _deckSets(src_dirs, build_dir):
+    # Returns the source and build directories of every deck set matched by
+    # src_dirs.
+    deck_sets = dict()
+    for pattern in src_dirs:
+        matched = sorted(glob.glob(pattern))
+        if not matched:
+            util.err("No deck sets found at '%s'." % (pattern,))
+        for src_dir in matched:
+            if not os.path.isdir(src_dir):
+                continue
+            src_dir = os.path.normpath(src_dir)
+            name = os.path.basename(os.path.abspath(src_dir))
+            other = deck_sets.setdefault(name, src_dir)
+            if os.path.realpath(other) != os.path.realpath(src_dir):
+                util.err("Deck sets '%s' and '%s' would both be built into "
+                         "'%s'." %
+                         (other, src_dir, os.path.join(build_dir, name)))
+    return [(src_dir, os.path.join(build_dir, name))
+            for name, src_dir in deck_sets.items()]
+
+
+def _planSet(src_dir, build_dir, cache, summary, options):
+    # Only the templates are cached across deck sets.
+    set_cache = dict()
+    project = _projectDecks(None, src_dir, options['lang'], options['where'],
+                            set_cache)
+    glbals = _readGlobals(src_dir,
+                          cache=cache,
+                          where=options['where'],
+                          project=project)
+    outputs = _planOutputs(glbals, None, src_dir, options['lang'], set_cache)
+    manifest, pending = _pendingOutputs(glbals,
+                                        outputs,
+                                        src_dir,
+                                        build_dir,
+                                        force=options['force'],
+                                        media_mode=options['media_mode'],
+                                        media_store=options['media_store'],
+                                        archive=options['archive'],
+                                        compact=options['compact'],
+                                        verbose=False)
+    summary['up_to_date'] += len(outputs) - len(pending)
+    return glbals, project, manifest, pending
+
+
+def _countBuilt(summary, built):
+    for output in built:
+        summary['built'] += 1
+        yield output
+
+
+def _setFailed(summary, src_dir, error):
+    util.warn("Failed to build deck set '%s': %s" % (src_dir, error))
+    summary['failed'].append((src_dir, str(error)))
+
+
+def _buildSetsParallel(deck_sets, cache, summary, options, jobs, io_threads,
+                       io_queue):
+    # The next deck set is planned while the workers build the ones before
+    # it.  Workers read the sources of a set themselves, when they get its
+    # first output, so the parent doesn't keep the notes of every set.
+    # Results are reported a set at a time, in order.
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=_initWorker,
+                             initargs=(None, None, options['media_mode'],
+                                       io_threads, io_queue,
+                                       util.timingsEnabled(),
+                                       _sourceCacheMode(),
+                                       sourcecache.maxBytes())) as pool:
+        running = []
+        try:
+            for src_dir, set_build_dir in deck_sets:
+                try:
+                    _, project, manifest, pending = _planSet(
+                        src_dir, set_build_dir, cache, summary, options)
+                except (RuntimeError, ValueError, OSError) as e:
+                    _setFailed(summary, src_dir, e)
+                    continue
+                running.append((src_dir, set_build_dir, manifest, pending, [
+                    pool.submit(_buildSetWorker, src_dir, set_build_dir,
+                                options['where'], project, output)
+                    for output in pending
+                ]))
+                while running and all(future.done()
+                                      for future in running[0][-1]):
+                    _finishSet(summary, *running.pop(0))
+            while running:
+                _finishSet(summary, *running.pop(0))
+        except BaseException:
+            for entry in running:
+                for future in entry[-1]:
+                    future.cancel()
+            raise
+
+
+def _finishSet(summary, src_dir, build_dir, manifest, pending, futures):
+    util.msg("Deck set: %s" % (src_dir,))
+    errors = []
+
+    def built():
+        for output, future in zip(pending, futures):
+            try:
+                util.mergeTimings(future.result())
+            except (RuntimeError, ValueError, OSError) as e:
+                errors.append(e)
+                continue
+            util.msg("Building deck: %s (Language: %s)" %
+                     (output['deck'], output['lang']))
+            yield output
+
+    try:
+        _recordOutputs(build_dir, manifest, _countBuilt(summary, built()))
+    except (RuntimeError, ValueError, OSError) as e:
+        errors.append(e)
+    if errors:
+        _setFailed(summary, src_dir, errors[0])
+
+
+def _readGlobals(src_dir,
+                 glbals=None,
+                 groups=SOURCE_GROUPS,
+                 cache=None,
+                 where=None,
+                 project=None,
+                 source_cache='write'):
+    # Reads the shared sources of a deck set.  Given the result of an
+    # earlier call, only the groups of sources named in 'groups' are read
+    # again.  With a parsed 'where' expression the notes are narrowed down to
+    # the selected rows, using indexes of the fields it tests.  With a
+    # projection, see util.projection, only the columns it keeps are loaded
+    # and only the languages it names are available.  'source_cache' is the
+    # sourcecache mode the templates and notes are loaded with.
+    inDir = lambda fn: os.path.join(src_dir, fn)
+    glbals = dict(glbals or ())
+    if 'json' in groups:
+        with util.timed('load: json'):
+            glbals.update(deck=util.getJson(inDir('deck.json')),
+                          config=util.getJson(inDir('config.json')),
+                          model=util.getJson(inDir('model.json')),
+                          desc=util.getRaw(inDir('desc.html')),
+                          css=util.getRaw(inDir('style.css')))
+    if 'media' in groups:
+        with util.timed('load: media'):
+            glbals['media'] = util.getMediaIndex(inDir('media'))
+    if 'templates' in groups:
+        with util.timed('load: templates'):
+            directory = inDir('templates')
+            files = [
+                os.path.join(directory, fn)
+                for fn in sorted(util.getFilesList(directory))
+                if os.path.splitext(fn)[1] == '.html'
+            ]
+            glbals['templates'] = _loadTemplates(src_dir, directory, files,
+                                                 cache, source_cache)
+    if 'data' in groups:
+        with util.timed('load: data.csv'):
+            glbals['data'] = util.csvLanguages(
+                *_loadData(src_dir, project, source_cache),
+                index=selection.fields(where) if where else ())
+            if project is not None and project[1] is not None:
+                glbals['data'] = {
+                    lang: data
+                    for lang, data in glbals['data'].items()
+                    if lang in project[1]
+                }
+        if where:
+            with util.timed('load: select rows'):
+                glbals['data'] = selection.select(glbals['data'], where)
+    return glbals
+
+
+def _loadData(src_dir, project=None, source_cache='write'):
+    # Shards are cached one by one, and the ones that have changed are
+    # parsed in parallel.  Each projection is cached separately.
+    fns = util.getDataFiles(src_dir)
+    cacheKind = lambda kind: kind if project is None else '%s %r' % (
+        kind, project)
+    if fns == [os.path.join(src_dir, 'data.csv')]:
+        return sourcecache.load(
+            src_dir, cacheKind('data'), fns[0], fns,
+            lambda: util.getCsvColumns(fns[0], project=project), source_cache)
+    if notestore.isStore(fns[0]):
+        return sourcecache.load(
+            src_dir, cacheKind('store'), fns[0], fns, lambda: util.csvColumns(
+                *notestore.readColumns(fns[0], project)), source_cache)
+
+    util.count('data shards', len(fns))
+    shards = [
+        sourcecache.lookup(src_dir, cacheKind('shard'), fn, [fn],
+                           source_cache) for fn in fns
+    ]
+    missing = [i for i, shard in enumerate(shards) if shard is None]
+    for i, shard in zip(
+            missing,
+            util.readCsvFiles([fns[i] for i in missing], project=project)):
+        sourcecache.store(src_dir,
+                          cacheKind('shard'),
+                          fns[i], [fns[i]],
+                          shard,
+                          mode=source_cache)
+        shards[i] = shard
+    return util.csvColumns(*util.mergeCsvShards(fns, shards))
+
+
+def _projectDecks(decks, src_dir, lang, where, cache):
+    # The projection of the notes that the decks need: their fields, the
+    # guids and tags and the fields tested by 'where', in 'lang' or in
+    # every language.  The decks are read into 'cache' for _planOutputs.
+    with util.timed('load: decks'):
+        decks_build = _readDecks(decks, os.path.join(src_dir, 'decks'),
+                                 cache)
+    fields = {'guid', 'tags'}
+    for deck_build in decks_build.values():
+        fields.update(deck_build.get('fields', ()))
+    if where:
+        fields.update(selection.fields(where))
+    return util.projection(fields, [lang] if lang else None)
+
+
+def _loadTemplates(src_dir, directory, files, cache, source_cache='write'):
+    # Deck sets built together often share their templates, through a
+    # symlinked directory for instance, so given a cache the parsed
+    # templates are kept by the real paths and stats of their files.
+    load = lambda: sourcecache.load(src_dir, 'templates', directory, files,
+                                    lambda: util.getTemplates(directory),
+                                    source_cache)
+    if cache is None:
+        return load()
+    key = []
+    for fn in files:
+        stat = os.stat(fn)
+        key.append((os.path.basename(fn), os.path.realpath(fn), stat.st_size,
+                    stat.st_mtime_ns))
+    entries = cache.setdefault('templates', dict())
+    key = tuple(key)
+    if key not in entries:
+        entries[key] = load()
+    else:
+        util.count('shared templates')
+    return entries[key]
+
+
+def _planOutputs(glbals, decks, src_dir, lang, cache=None):
+    cache = dict() if cache is None else cache
     languages = list(glbals['data'].keys())
     if lang:
         if lang not in languages:
             util.err("Language '%s' is not available." % (lang,))
         languages = [lang]
 
-    for lang in languages:
-        decks_build = _readDecks(decks, os.path.join(src_dir, 'decks'))
-        for deck, deck_build in decks_build.items():
-            util.msg("Building deck: %s (Language: %s)" % (deck, lang))
-
-            deck_build['deck']['uuid'] = util.uuidEncode(
-                deck_build['deck']['uuid'], lang)
-            deck_build['config']['uuid'] = util.uuidEncode(
-                deck_build['config']['uuid'], lang)
-            deck_build['model']['uuid'] = util.uuidEncode(
-                deck_build['model']['uuid'], lang)
-
-            deck_data = {
-                '__type__':
-                    'Deck',
-                'crowdanki_uuid':
-                    deck_build['deck']['uuid'],
-                'name':
-                    util.filenameToDeck(deck if lang ==
-                                        'default' else "%s[%s]" % (deck, lang)),
-                'desc':
-                    deck_build.get('@desc') or glbals['desc']
-            }
-            deck_data.update(glbals['deck'])
-            deck_data.update(deck_build['@deck'])
-
-            deck_data['deck_configurations'] = [{
-                '__type__': 'DeckConfig',
-                'crowdanki_uuid': deck_build['config']['uuid'],
-                'name': deck_build['config']['name']
-            }]
-            deck_data['deck_configurations'][-1].update(glbals['config'])
-            deck_data['deck_configurations'][-1].update(deck_build['@config'])
-
-            deck_data['deck_config_uuid'] = deck_build['config']['uuid']
-
-            deck_templates_info = []
-            k = 0
-            for template in deck_build['templates']:
-                template_filename = util.ensureFilename(template)
-                if not template_filename in glbals['templates']:
-                    util.err("Field template '%s% not found." % (template,))
-                deck_templates_info.append(dict(name=template, ord=k))
-                deck_templates_info[-1].update(
-                    glbals['templates'][template_filename])
-                k += 1
-
-            deck_fields_info = []
-            i = 0
-            for field in deck_build['fields']:
-                if field not in glbals['data'][lang]:
-                    util.err("Field '%s' not found" % (field,))
-                deck_fields_info.append(dict(name=field, ord=i))
-                deck_fields_info[-1].update(util.getFieldDefaults())
-                i += 1
-            deck_data['note_models'] = [{
-                '__type__': 'NoteModel',
-                'crowdanki_uuid': deck_build['model']['uuid'],
-                'name': deck_build['model']['name'],
-                'flds': deck_fields_info,
-                'tmpls': deck_templates_info,
-                'css': deck_build.get('@css') or glbals['css']
-            }]
-            deck_data['note_models'][-1].update(glbals['model'])
-            deck_data['note_models'][-1].update(deck_build['@model'])
-
-            if 'guid' not in glbals['data'][lang]:
-                util.err("Missed required 'guid' column in 'data.csv'")
-
-            if len(glbals['data'][lang]['guid']) != len(
-                    set(glbals['data'][lang]['guid'])):
-                util.err(
-                    "Found duplicate values in 'guid' column.  Run 'index' command."
-                )
-
-            deck_fields_data = defaultdict(lambda: defaultdict(list))
-            deck_media = []
-            for field in deck_build['fields']:
-                if field not in glbals['data'][lang]:
-                    util.err("Column '%s' is missing in 'data.csv'." % (field,))
-                for i, cell in enumerate(glbals['data'][lang][field]):
-                    deck_fields_data[i]['fields'].append(cell)
-                    # FIXME: This seems like it would lead to duplicates
-                    # Should it be seeing if the media_file is referenced??
-                    for media_file in glbals['media']:
-                        if cell in media_file:
-                            deck_media.append(media_file)
-
-            for i, cell in enumerate(glbals['data'][lang]['guid']):
-                if not cell:
-                    util.err("""Missing value in the 'guid' field in the row:
-
-'index' command to fix the problem.""" %
-                             (util.toJson(deck_fields_data[i]['fields']),))
-                deck_fields_data[i]['guid'] = util.guidDecode(
-                    cell, deck_build['model']['uuid'])
-
-            if 'tags' in glbals['data'][lang]:
-                for i, cell in enumerate(glbals['data'][lang]['tags']):
-                    deck_fields_data[i]['tags'] = cell.split(' ')
-
-            deck_data['media_files'] = deck_media
-            deck_data['notes'] = []
-            for i, row in sorted(deck_fields_data.items(), key=lambda x: x[0]):
-                deck_data['notes'].append({
-                    '__type__': 'Note',
-                    'data': '',
-                    'fields': row['fields'],
-                    'flags': 0,
-                    'guid': row['guid'],
-                    'note_model_uuid': deck_build['model']['uuid'],
-                    'tags': row.get('tags') or []
-                })
-
-            localized_deck = deck if lang == 'default' else '_'.join(
-                (deck, lang))
-            build_dir = build_dir or 'build'
-            deck_dir = os.path.join(build_dir, localized_deck)
-            util.prepareDir(deck_dir)
-            with open(os.path.join(deck_dir, localized_deck + '.json'),
-                      'w') as f:
-                f.write(util.toJson(deck_data))
-
-            util.prepareDir(os.path.join(deck_dir, 'media'))
-            for media_file in deck_media:
-                shutil.copy(os.path.join(src_dir, 'media', media_file),
-                            os.path.join(deck_dir, 'media', media_file))
-
-
-def _readDecks(decks, directory):
+    with util.timed('load: decks'):
+        decks_build = _readDecks(decks, os.path.join(src_dir, 'decks'), cache)
+
+    # Everything that doesn't depend on the language is worked out once per
+    # deck and shared by the outputs of all languages.
+    outputs = []
+    with util.timed('build: plan'):
+        plans = [
+            _planDeck(glbals, deck, deck_build)
+            for deck, deck_build in decks_build.items()
+        ]
+        for lang in languages:
+            for plan in plans:
+                outputs.append(_planOutput(glbals, plan, lang, cache))
+    return outputs
+
+
+def _planDeck(glbals, deck, deck_build):
+    templates_info = []
+    for k, template in enumerate(deck_build['templates']):
+        template_filename = util.ensureFilename(template)
+        if not template_filename in glbals['templates']:
+            util.err("Field template '%s' not found." % (template,))
+        templates_info.append(dict(name=template, ord=k))
+        templates_info[-1].update(glbals['templates'][template_filename])
+
+    fields_info = []
+    for i, field in enumerate(deck_build['fields']):
+        fields_info.append(dict(name=field, ord=i))
+        fields_info[-1].update(util.getFieldDefaults())
+
+    return dict(deck=deck,
+                build=deck_build,
+                templates_info=templates_info,
+                fields_info=fields_info)
+
+
+def _planOutput(glbals, plan, lang, cache):
+    deck, deck_build = plan['deck'], plan['build']
+    data = glbals['data'][lang]
+    for field in deck_build['fields']:
+        if field not in data:
+            util.err("Column '%s' is missing in 'data.csv'." % (field,))
+    _checkGuids(cache, data, [data[field] for field in deck_build['fields']])
+
+    # Media references are collected per column, so columns shared between
+    # decks and languages are only scanned once.
+    media = dict()
+    for field in deck_build['fields']:
+        media.update(
+            dict.fromkeys(_columnMedia(cache, data[field], glbals['media'])))
+
+    return dict(plan,
+                lang=lang,
+                name=deck if lang == 'default' else '_'.join((deck, lang)),
+                media=list(media))
+
+
+def _checkGuids(cache, data, field_columns):
+    # The guid column is shared by all languages, so it's only scanned once.
+    if 'guid' not in data:
+        util.err("Missed required 'guid' column in 'data.csv'")
+
+    guids = data['guid']
+    entries = cache.setdefault('guids', dict())
+    entry = entries.get(id(guids))
+    if not entry or entry[0] is not guids:
+        missing = next((i for i, guid in enumerate(guids) if not guid), None)
+        entry = entries[id(guids)] = (guids, len(guids) != len(set(guids)),
+                                      missing)
+    _, duplicates, missing = entry
+
+    if duplicates:
+        util.err(
+            "Found duplicate values in 'guid' column.  Run 'index' command."
+        )
+
+    if missing is not None:
+        util.err("""Missing value in the 'guid' field in the row:
+
+%s
+
+Run 'index' command to fix the problem.""" %
+                 (util.toJson([column[missing] for column in field_columns]),))
+
+
+def _columnMedia(cache, column, media_index):
+    entries = cache.setdefault('media', dict())
+    entry = entries.get(id(column))
+    if not entry or entry[0] is not column or entry[1] is not media_index:
+        entry = entries[id(column)] = (column, media_index,
+                                       util.getMediaRefs(column, media_index))
+    return entry[2]
+
+
+def _columnHash(cache, column):
+    entries = cache.setdefault('hashes', dict())
+    entry = entries.get(id(column))
+    if not entry or entry[0] is not column:
+        entry = entries[id(column)] = (column, util.hashColumn(column))
+    return entry[1]
+
+
+def _buildOutputs(glbals,
+                  outputs,
+                  src_dir,
+                  build_dir,
+                  jobs=1,
+                  force=False,
+                  media_mode='copy',
+                  media_store=False,
+                  io_threads=IO_THREADS,
+                  io_queue=IO_QUEUE_DEPTH,
+                  archive=None,
+                  compact=False,
+                  cache=None,
+                  verbose=True):
+    if archive and media_store:
+        util.err("A media store can't be used when building archives.")
+    manifest, pending = _pendingOutputs(glbals, outputs, src_dir, build_dir,
+                                        force, media_mode, media_store,
+                                        archive, compact, cache, verbose)
+
+    if jobs > 1 and len(pending) > 1:
+        built = _buildParallel(glbals, pending, build_dir, media_mode, jobs,
+                               io_threads, io_queue)
+    else:
+        built = _buildSerial(glbals, pending, build_dir, media_mode,
+                             io_threads, io_queue)
+    _recordOutputs(build_dir, manifest, built)
+    return pending
+
+
+def _pendingOutputs(glbals,
+                    outputs,
+                    src_dir,
+                    build_dir,
+                    force=False,
+                    media_mode='copy',
+                    media_store=False,
+                    archive=None,
+                    compact=False,
+                    cache=None,
+                    verbose=True):
+    # Returns the build manifest and the outputs which aren't up to date.
+    cache = dict() if cache is None else cache
+    manifest = _readManifest(build_dir)
+    if force:
+        for output in outputs:
+            manifest['outputs'].pop(output['name'], None)
+    pending = []
+    with util.timed('build: check manifest'):
+        for output in _checkOutputs(glbals, outputs, manifest, src_dir,
+                                    build_dir, media_mode, media_store,
+                                    archive, compact, cache):
+            built = manifest['outputs'].get(output['name'], {})
+            if output['key'] == built.get('key') and os.path.exists(
+                    _outputFile(build_dir, output)):
+                if verbose:
+                    util.msg("Deck is up to date: %s (Language: %s)" %
+                             (output['deck'], output['lang']))
+            else:
+                pending.append(output)
+    return manifest, pending
+
+
+def _recordOutputs(build_dir, manifest, built):
+    # Adds the outputs from 'built' to the manifest as they are built.  The
+    # manifest is written even when the build fails, so that the decks
+    # built until then aren't built again.
+    try:
+        for output in built:
+            manifest['outputs'][output['name']] = dict(
+                key=output['key'],
+                placement=output['placement'],
+                media=dict((media_file, manifest['media'][media_file][2])
+                           for media_file in output['media']))
+    finally:
+        _writeManifest(build_dir, manifest)
+
+
+def _readManifest(build_dir):
+    manifest = None
+    try:
+        manifest = util.getJson(os.path.join(build_dir, MANIFEST_FILE),
+                                required=False)
+    except ValueError:
+        util.warn("Ignoring corrupt build manifest in '%s'." % (build_dir,))
+    if not manifest or manifest.get('version') != MANIFEST_VERSION:
+        manifest = dict(version=MANIFEST_VERSION, outputs={}, media={})
+    return manifest
+
+
+def _writeManifest(build_dir, manifest):
+    util.prepareDir(build_dir)
+    fn = os.path.join(build_dir, MANIFEST_FILE)
+    with open(fn + '.tmp', 'w') as f:
+        f.write(util.toJson(manifest))
+    os.replace(fn + '.tmp', fn)
+
+
+def _checkOutputs(glbals, outputs, manifest, src_dir, build_dir, media_mode,
+                  media_store, archive, compact, cache):
+    # Fingerprint everything that feeds each output and work out which of
+    # its media files still have to be placed and where to take them from.
+    # Media hashes are reused from the manifest while the size and mtime of
+    # the file are unchanged.  With a media store every distinct file is
+    # copied into the build directory once, named by its hash, and outputs
+    # are populated from there.  Archives are always written whole, with the
+    # media taken straight from the sources.  An output built as an archive
+    # and as a directory in turn is rebuilt each time, as only the last
+    # build is recorded.
+    placement = None if archive else [media_mode, bool(media_store)]
+    shared = util.hashJson([
+        MANIFEST_VERSION, glbals['deck'], glbals['config'], glbals['model'],
+        glbals['desc'], glbals['css'], compact, archive, placement
+    ])
+    for output in outputs:
+        for media_file in output['media']:
+            fn = os.path.join(src_dir, 'media', media_file)
+            stat = os.stat(fn)
+            cached = manifest['media'].get(media_file)
+            if not cached or cached[:2] != [stat.st_size, stat.st_mtime_ns]:
+                manifest['media'][media_file] = [
+                    stat.st_size, stat.st_mtime_ns,
+                    util.hashFile(fn)
+                ]
+
+        data = glbals['data'][output['lang']]
+        deck_build = output['build']
+        output['key'] = util.hashJson([
+            shared, output['deck'], output['lang'], deck_build,
+            [
+                glbals['templates'].get(util.ensureFilename(template))
+                for template in deck_build['templates']
+            ],
+            [
+                _columnHash(cache, data[field]) if field in data else None
+                for field in ['guid', 'tags'] + deck_build['fields']
+            ],
+            [[media_file, manifest['media'][media_file][2]]
+             for media_file in output['media']]
+        ])
+
+        # Media placed another way are placed again.
+        built = manifest['outputs'].get(output['name'], {})
+        copied = built.get('media', {})
+        if archive or built.get('placement') != placement:
+            copied = dict()
+        output['placement'] = placement
+        output['archive'] = archive
+        output['compact'] = compact
+        output['copy_media'] = []
+        for media_file in output['media']:
+            digest = manifest['media'][media_file][2]
+            if copied.get(media_file) == digest and os.path.exists(
+                    os.path.join(build_dir, output['name'], 'media',
+                                 media_file)):
+                continue
+            source = os.path.join(src_dir, 'media', media_file)
+            if media_store:
+                source = _storeMedia(source, digest, build_dir, media_mode)
+            output['copy_media'].append((media_file, source))
+        yield output
+
+
+def _storeMedia(source, digest, build_dir, media_mode):
+    _, ext = os.path.splitext(source)
+    stored = os.path.join(build_dir, MEDIA_STORE_DIR, digest[:2],
+                          digest + ext)
+    if not os.path.exists(stored):
+        util.prepareDir(os.path.dirname(stored))
+        util.placeFile(source, stored + '.tmp',
+                       'reflink' if media_mode == 'reflink' else 'copy')
+        os.replace(stored + '.tmp', stored)
+    return stored
+
+
+def _deckFile(build_dir, output):
+    return os.path.join(build_dir, output['name'], output['name'] + '.json')
+
+
+def _outputFile(build_dir, output):
+    if output['archive']:
+        return os.path.join(build_dir,
+                            output['name'] + ARCHIVE_FORMATS[output['archive']])
+    return _deckFile(build_dir, output)
+
+
+class _Pipeline:
+    # Runs the file writes and media placement of a build on a pool of I/O
+    # threads while the calling thread assembles the next deck.  At most
+    # 'depth' jobs, and 'depth' JSON chunks per deck, wait in the queue,
+    # which bounds the memory held by output that hasn't been written yet.
+
+    def __init__(self, threads, depth):
+        self._pool = ThreadPoolExecutor(max_workers=max(1, threads))
+        self._depth = max(1, depth)
+        self._slots = threading.BoundedSemaphore(self._depth)
+
+    def submit(self, fn, *args):
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def stream(self, fn, *args):
+        # Returns a file-like object whose contents are passed to
+        # fn(chunks, *args) on a pool thread as a queue of strings ending
+        # with None.
+        chunks = queue.Queue(self._depth)
+        return _ChunkWriter(chunks, self.submit(fn, chunks, *args))
+
+    def shutdown(self):
+        self._pool.shutdown()
+
+
+class _ChunkWriter:
+    # File-like object which queues what is written to it in chunks of about
+    # JSON_CHUNK_SIZE characters.  Once the consumer has stopped, because it
+    # failed, chunks are dropped; the error is raised from its future.
+
+    def __init__(self, chunks, future):
+        self._chunks = chunks
+        self._future = future
+        self._buffer = []
+        self._size = 0
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= JSON_CHUNK_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._put(''.join(self._buffer))
+            self._buffer = []
+            self._size = 0
+
+    def _put(self, chunk):
+        while not self._future.done():
+            try:
+                self._chunks.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        try:
+            self._flush()
+        finally:
+            self._put(None)
+        return self._future
+
+
+def _writeChunks(chunks, fn):
+    with open(fn, 'w') as f:
+        for chunk in iter(chunks.get, None):
+            f.write(chunk)
+
+
+def _writeArchive(chunks, fn, archive, name, media):
+    # Writes the deck JSON and its media straight into an archive laid out
+    # like the build directory.  tar needs the size of an entry up front, so
+    # the JSON is spooled there, in memory while it's small.
+    tmp = fn + '.tmp'
+    json_name = '%s/%s.json' % (name, name)
+    try:
+        if archive == 'zip':
+            with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as zf:
+                with zf.open(json_name, 'w', force_zip64=True) as entry:
+                    for chunk in iter(chunks.get, None):
+                        entry.write(chunk.encode('utf-8'))
+                # Audio and images hardly compress, so they're stored.
+                for media_file, source in media:
+                    zf.write(source, '%s/media/%s' % (name, media_file),
+                             zipfile.ZIP_STORED)
+        else:
+            # Media files that are symlinks are stored as the files they
+            # point to, like in zip archives and build directories.
+            with tarfile.open(tmp, 'w:gz', dereference=True) as tf:
+                with tempfile.SpooledTemporaryFile(ARCHIVE_SPOOL_SIZE) as spool:
+                    for chunk in iter(chunks.get, None):
+                        spool.write(chunk.encode('utf-8'))
+                    info = tarfile.TarInfo(json_name)
+                    info.size = spool.tell()
+                    info.mtime = int(time.time())
+                    info.mode = 0o644
+                    spool.seek(0)
+                    tf.addfile(info, spool)
+                for media_file, source in media:
+                    tf.add(source, '%s/media/%s' % (name, media_file))
+        os.replace(tmp, fn)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _placeMedia(media_dir, copy_media, media_mode):
+    for media_file, source in copy_media:
+        util.placeFile(source, os.path.join(media_dir, media_file),
+                       media_mode)
+
+
+def _finishDeck(build_dir, output, futures):
+    with util.timed('build: wait for io'):
+        for future in futures:
+            future.result()
+    util.count('bytes written', os.path.getsize(_outputFile(build_dir,
+                                                            output)))
+
+
+def _buildSerial(glbals, outputs, build_dir, media_mode, io_threads,
+                 io_queue):
+    # The I/O of each deck is finished, and the deck reported as built,
+    # while the next one is being assembled.
+    pipeline = _Pipeline(io_threads, io_queue)
+    previous = None
+    try:
+        for output in outputs:
+            util.msg("Building deck: %s (Language: %s)" %
+                     (output['deck'], output['lang']))
+            with util.timed('deck: %s' % (output['name'],)):
+                futures = _buildDeck(glbals, output, build_dir, media_mode,
+                                     pipeline)
+            if previous:
+                _finishDeck(build_dir, *previous)
+                yield previous[0]
+            previous = (output, futures)
+        if previous:
+            _finishDeck(build_dir, *previous)
+            yield previous[0]
+    finally:
+        pipeline.shutdown()
+
+
+def _buildParallel(glbals, outputs, build_dir, media_mode, jobs, io_threads,
+                   io_queue):
+    # The parsed sources are handed to each worker once, when it starts.
+    # Results are reported in submission order so that the progress output
+    # reads the same as in a serial build.
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=_initWorker,
+                             initargs=(glbals, build_dir, media_mode,
+                                       io_threads, io_queue,
+                                       util.timingsEnabled(),
+                                       _sourceCacheMode(),
+                                       sourcecache.maxBytes())) as pool:
+        futures = [pool.submit(_buildWorker, output) for output in outputs]
+        try:
+            for output, future in zip(outputs, futures):
+                util.msg("Building deck: %s (Language: %s)" %
+                         (output['deck'], output['lang']))
+                util.mergeTimings(future.result())
+                yield output
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+_worker = dict()
+
+
+def _initWorker(glbals, build_dir, media_mode, io_threads, io_queue,
+                timings, source_cache, cache_bytes):
+    # Workers don't inherit the settings of the parent when they are spawned
+    # rather than forked, so these are passed along.
+    _worker.update(glbals=glbals,
+                   build_dir=build_dir,
+                   media_mode=media_mode,
+                   source_cache=source_cache,
+                   pipeline=_Pipeline(io_threads, io_queue))
+    if timings:
+        util.enableTimings()
+    sourcecache.setMaxBytes(cache_bytes)
+
+
+def _sourceCacheMode():
+    return 'write' if sourcecache.isEnabled() else 'off'
+
+
+def _buildSetWorker(src_dir, build_dir, where, project, output):
+    # Used when the workers build the outputs of several deck sets.  The
+    # sources of the last set are kept, since its outputs come together.
+    if _worker.get('src_dir') != src_dir:
+        _worker.update(src_dir=None, glbals=None)
+        _worker['glbals'] = _readGlobals(src_dir,
+                                         groups=('json', 'data'),
+                                         where=where,
+                                         project=project,
+                                         source_cache=_worker['source_cache'])
+        _worker['src_dir'] = src_dir
+    _worker['build_dir'] = build_dir
+    return _buildWorker(output)
+
+
+def _buildWorker(output):
+    with util.timed('deck: %s' % (output['name'],)):
+        futures = _buildDeck(_worker['glbals'], output, _worker['build_dir'],
+                             _worker['media_mode'], _worker['pipeline'])
+        _finishDeck(_worker['build_dir'], output, futures)
+    return util.takeTimings()
+
+
+def _buildDeck(glbals, output, build_dir, media_mode, pipeline):
+    # Returns the futures of the file writes and media placement submitted
+    # to 'pipeline'.
+    deck_data, notes = _deckDocument(glbals, output)
+    data = glbals['data'][output['lang']]
+    field_count = len(output['build']['fields'])
+
+    copy_media = output['copy_media']
+    util.count('media files', len(copy_media))
+    util.count('media bytes',
+               sum(os.path.getsize(source) for _, source in copy_media))
+
+    futures = []
+    if output['archive']:
+        util.prepareDir(build_dir)
+        writer = pipeline.stream(_writeArchive,
+                                 _outputFile(build_dir, output),
+                                 output['archive'], output['name'], copy_media)
+    else:
+        media_dir = os.path.join(build_dir, output['name'], 'media')
+        util.prepareDir(media_dir)
+        with util.timed('build: media'):
+            for i in range(0, len(copy_media), MEDIA_BATCH_SIZE):
+                futures.append(
+                    pipeline.submit(_placeMedia, media_dir,
+                                    copy_media[i:i + MEDIA_BATCH_SIZE],
+                                    media_mode))
+        writer = pipeline.stream(_writeChunks, _deckFile(build_dir, output))
+
+    with util.timed('build: write json'):
+        try:
+            util.writeJsonStream(writer, deck_data, 'notes', notes,
+                                 output['compact'])
+        finally:
+            futures.append(writer.close())
+    util.count('rows', len(data['guid']))
+    util.count('cells', len(data['guid']) * field_count)
+    return futures
+
+
+def _deckDocument(glbals, output):
+    # Returns the deck JSON of an output without its notes, which are
+    # generated by the iterator returned with it.
+    deck, deck_build, lang = output['deck'], output['build'], output['lang']
+    deck_uuid = util.uuidEncode(deck_build['deck']['uuid'], lang)
+    config_uuid = util.uuidEncode(deck_build['config']['uuid'], lang)
+    model_uuid = util.uuidEncode(deck_build['model']['uuid'], lang)
+
+    deck_data = {
+        '__type__':
+            'Deck',
+        'crowdanki_uuid':
+            deck_uuid,
+        'name':
+            util.filenameToDeck(deck if lang ==
+                                'default' else "%s[%s]" % (deck, lang)),
+        'desc':
+            deck_build.get('@desc') or glbals['desc']
+    }
+    deck_data.update(glbals['deck'])
+    deck_data.update(deck_build['@deck'])
+
+    deck_data['deck_configurations'] = [{
+        '__type__': 'DeckConfig',
+        'crowdanki_uuid': config_uuid,
+        'name': deck_build['config']['name']
+    }]
+    deck_data['deck_configurations'][-1].update(glbals['config'])
+    deck_data['deck_configurations'][-1].update(deck_build['@config'])
+
+    deck_data['deck_config_uuid'] = config_uuid
+
+    deck_data['note_models'] = [{
+        '__type__': 'NoteModel',
+        'crowdanki_uuid': model_uuid,
+        'name': deck_build['model']['name'],
+        'flds': output['fields_info'],
+        'tmpls': output['templates_info'],
+        'css': deck_build.get('@css') or glbals['css']
+    }]
+    deck_data['note_models'][-1].update(glbals['model'])
+    deck_data['note_models'][-1].update(deck_build['@model'])
+
+    data = glbals['data'][lang]
+    field_columns = [data[field] for field in deck_build['fields']]
+
+    deck_data['media_files'] = output['media']
+    deck_data.pop('notes', None)
+    return deck_data, _iterNotes(data, field_columns, model_uuid)
+
+
+def _iterNotes(data, field_columns, model_uuid):
+    tags = data['tags'] if 'tags' in data else None
+    guids = util.guidDecodeColumn(data['guid'], model_uuid)
+    for i, guid in enumerate(guids):
+        yield {
+            '__type__': 'Note',
+            'data': '',
+            'fields': [column[i] for column in field_columns],
+            'flags': 0,
+            'guid': guid,
+            'note_model_uuid': model_uuid,
+            'tags': tags[i].split(' ') if tags is not None else []
+        }
+
+
+def _readDecks(decks, directory, cache=None):
     decks_data = dict()
+    read = cache.setdefault('decks', dict()) if cache is not None else dict()
 
     if not decks:
         decks = util.getFilesList(directory)
 
     for deck in decks:
         deck_filename = util.deckToFilename(deck)
-    dirnm = os.path.join(directory, deck_filename)
-    if os.path.exists(dirnm) and os.path.isdir(dirnm):
-        decks_data[deck_filename] = _readDeck(dirnm)
-    else:
-        util.err("Deck not found: %s" % (dirnm,))
+        dirnm = os.path.join(directory, deck_filename)
+        if os.path.exists(dirnm) and os.path.isdir(dirnm):
+            if dirnm not in read:
+                read[dirnm] = _readDeck(dirnm)
+            decks_data[deck_filename] = read[dirnm]
+        else:
+            util.err("Deck not found: %s" % (dirnm,))
 
     return decks_data
 
@@ -1,113 +1,196 @@
+import ankidmpy.notestore as notestore
 import ankidmpy.util as util
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 import csv
+from itertools import islice
+import json
 import os.path
+import re
+import tempfile
 
+MEDIA_COPY_THREADS = 8
+GUID_BATCH = 10000
 
-def importIt(path, directory, deck=None):
-    path = path.rstrip('/')
-    _, basename = os.path.split(path)
-    filenm = os.path.join(path, basename + '.json')
-    if not os.path.exists(filenm):
-        filenm = os.path.join(path, 'deck.json')
+
+def importIt(path, directory, deck=None, sqlite=False):
+    path, filenm = _exportFile(path)
 
     directory = directory.rstrip('/')
     if not directory:
         directory = 'src'
 
     build_info = defaultdict(dict)
+    build_info['model']['uuid'] = util.createUuid()
+    if sqlite:
+        write = lambda header, rows: notestore.writeRows(
+            notestore.storeFile(directory), header, rows)
+    else:
+        write = lambda header, rows: _writeCsv(
+            os.path.join(directory, 'data.csv'), header, rows)
 
-    deck_data = util.getJson(filenm)
+    deck_data = _readExport(
+        filenm, {'deck_configurations', 'note_models'},
+        lambda deck_data, notes: write(*_noteRows(deck_data['note_models'][
+            0], notes, build_info['model']['uuid'])))
 
-    if len(deck_data['deck_configurations']) > 1 or len(
-            deck_data['note_models']) > 1:
-        util.err("Multiple models or configurations per deck is not supported")
+    build_info['deck']['uuid'] = util.createUuid()
+    build_info['config']['uuid'] = util.createUuid()
 
-    if len(deck_data['deck_configurations']) == 0 or len(
-            deck_data['note_models']) == 0:
-        util.err(
-            "Decks with empty models or configurations are note supported.  Try adding one card in your deck."
-        )
+    with util.timed('import: media'):
+        _copyMedia(path, directory, deck_data['media_files'], shutil.copy)
 
-    build_info['deck']['uuid'] = util.createUuid()
+    deck = _writeSources(directory, deck_data, build_info, deck)
+    util.msg("Created deck: %s" % (deck,))
+
+
+def mergeIt(path, directory, deck=None, delete=False):
+    # Applies a newer export of a deck to the deck set it was built from.
+    # Notes are matched by the guid they were built with, and the uuids of
+    # the existing deck are kept.  Notes missing from the export are only
+    # deleted when asked to, as a deck built with --where holds just some
+    # of them.
+    path, filenm = _exportFile(path)
+
+    directory = directory.rstrip('/')
+    if not directory:
+        directory = 'src'
+
+    csvfns = util.getDataFiles(directory)
+    if not os.path.exists(csvfns[0]):
+        util.err("Nothing to merge into, '%s' doesn't exist." % (csvfns[0],))
+
+    build_info = dict()
+    changes = dict()
+
+    def mergeNotes(deck_data, notes):
+        name, lang = deck or deck_data['name'], None
+        deckDir = lambda name: os.path.join(directory, 'decks',
+                                            util.deckToFilename(name))
+        if not deck and not os.path.isdir(deckDir(name)):
+            # Translations are built as 'Deck[lang]'.
+            match = re.fullmatch(r'(.+)\[([^\[\]]+)\]', name)
+            if match:
+                name, lang = match.groups()
+        if not os.path.isdir(deckDir(name)):
+            util.err("Deck not found: %s" % (deckDir(name),))
+        build_info.update(util.getJson(os.path.join(deckDir(name),
+                                                    'build.json')))
+
+        changes.update(
+            _mergeCsv(csvfns, deck_data['note_models'][0], notes,
+                      build_info['model']['uuid'], name, lang, delete))
+        changes['deck'] = name
 
-    dictSlice = lambda d, kys: {key: d[key] for key in d.keys() & kys}
+    required = {'deck_configurations', 'note_models'}
+    if not deck:
+        required.add('name')
+    deck_data = _readExport(filenm, required, mergeNotes)
+
+    with util.timed('import: media'):
+        copied = _copyMedia(path, directory, deck_data['media_files'],
+                            _copyChanged)
+
+    deck = _writeSources(directory,
+                         deck_data,
+                         build_info,
+                         changes['deck'],
+                         merge=True)
+    util.msg(
+        "Merged deck: %s (Language: %s, %d notes inserted, %d updated, %d deleted, %d media files copied)"
+        % (deck, changes['lang'], changes['inserted'], changes['updated'],
+           changes['deleted'], sum(copied)))
+    if changes['missing']:
+        util.msg("Kept %d notes missing from the export, pass --delete to "
+                 "delete them." % (changes['missing'],))
+
+
+def _exportFile(path):
+    path = path.rstrip('/')
+    _, basename = os.path.split(path)
+    filenm = os.path.join(path, basename + '.json')
+    if not os.path.exists(filenm):
+        filenm = os.path.join(path, 'deck.json')
+    return path, filenm
+
+
+def _readExport(filenm, required, write_notes):
+    # Notes are streamed straight into write_notes when the keys in
+    # 'required' precede them in the export, as they do in CrowdAnki's
+    # sorted output.  Otherwise they are spooled to a temporary file until
+    # the whole export has been read.
+    deck_data = dict()
+    streamed = False
+    with util.timed('import: notes'), open(filenm) as f, tempfile.TemporaryFile(
+            'w+') as spool:
+        for key, value in util.iterJsonObject(f, lazy=('notes',)):
+            if key != 'notes':
+                deck_data[key] = value
+            elif deck_data.keys() >= required:
+                _checkModels(deck_data)
+                write_notes(deck_data, value)
+                streamed = True
+            else:
+                for note in value:
+                    spool.write(json.dumps(note))
+                    spool.write('\n')
+
+        _checkModels(deck_data)
+        if not streamed:
+            spool.seek(0)
+            write_notes(deck_data, map(json.loads, spool))
+    return deck_data
+
+
+def _writeSources(directory, deck_data, build_info, deck, merge=False):
+    # When merging, only files whose contents change are written.  Keys are
+    # kept in the order of the export.
+    write = _writeChanged if merge else _writeFile
+    dictSlice = lambda d, kys: {key: d[key] for key in d if key in kys}
 
     deck_info = dictSlice(deck_data, {'dyn', 'extendNew', 'extendRev'})
     deck_info['children'] = []
-    with open(os.path.join(directory, 'deck.json'), 'w') as f:
-        f.write(util.toJson(deck_info))
+    write(os.path.join(directory, 'deck.json'), util.toJson(deck_info))
 
     configuration = deck_data['deck_configurations'][0]
-    build_info['config']['uuid'] = util.createUuid()
     build_info['config']['name'] = configuration['name']
     configuration_info = dictSlice(configuration, {
         'autoplay', 'dyn', 'lapse', 'maxTaken', 'new', 'replayq', 'rev', 'timer'
     })
-    with open(os.path.join(directory, 'config.json'), 'w') as f:
-        f.write(util.toJson(configuration_info))
+    write(os.path.join(directory, 'config.json'),
+          util.toJson(configuration_info))
 
-    desc = deck_data['desc']
-    with open(os.path.join(directory, 'desc.html'), 'w') as f:
-        f.write(desc)
+    write(os.path.join(directory, 'desc.html'), deck_data['desc'])
 
     # FIXME: This is the requirement that there be only one model
     model = deck_data['note_models'][0]
-    build_info['model']['uuid'] = util.createUuid()
     build_info['model']['name'] = model['name']
     model_info = dictSlice(model, {'latexPost', 'latexPre', 'type'})
     model_info['vers'] = []
-
-    with open(os.path.join(directory, 'model.json'), 'w') as f:
-        f.write(util.toJson(model_info))
+    write(os.path.join(directory, 'model.json'), util.toJson(model_info))
 
     field_list = [v['name'] for v in model['flds']]
 
-    notes = deck_data['notes']
-    header = ['guid'] + field_list + ['tags']
-    csvfn = os.path.join(directory, 'data.csv')
-    try:
-        with open(csvfn, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(header)
-            for note in notes:
-                row = [
-                    util.guidEncode(note['guid'], build_info['model']['uuid'])
-                ]
-
-                for i, field in enumerate(field_list):
-                    row.append(note['fields'][i])
-                row.append(' '.join(note['tags']))
-
-                writer.writerow(row)
-
-    except PermissionError:
-        util.err("Cannot write to file: %s" % (csvfn,))
-
-    media_files = deck_data['media_files']
-    util.prepareDir(os.path.join(directory, 'media'))
-    for media_file in media_files:
-        shutil.copy(os.path.join(path, 'media', media_file),
-                    os.path.join(directory, 'media', media_file))
-
     templates = model['tmpls']
     fulltemplateDirname = os.path.join(directory, 'templates')
     util.prepareDir(fulltemplateDirname)
     for template in templates:
         template_filename = util.ensureFilename(template['name'])
-        with open(
-                os.path.join(fulltemplateDirname, template_filename + '.html'),
-                'w') as f:
-            f.write(template['qfmt'])
-            f.write("\n\n--\n\n")
-            f.write(template['afmt'])
+        fn = os.path.join(fulltemplateDirname, template_filename + '.html')
+        # Templates don't survive a round trip byte for byte, so they are
+        # compared the way a build reads them.
+        if merge and os.path.exists(fn) and util.splitTemplate(
+                util.getRaw(fn)) == (template['qfmt'], template['afmt']):
+            continue
+        _writeFile(fn, template['qfmt'] + "\n\n--\n\n" + template['afmt'])
 
     template_list = [v['name'] for v in templates]
 
     css = model['css']
-    with open(os.path.join(directory, 'style.css'), 'w') as f:
-        f.write(css + '\n')
+    if not css.endswith('\n'):
+        css += '\n'
+    write(os.path.join(directory, 'style.css'), css)
 
     if deck:
         deck_name = deck
@@ -120,7 +203,252 @@ def importIt(path, directory, deck=None):
     util.prepareDir(fulldirname)
 
     build_info.update({'fields': field_list, 'templates': template_list})
-    with open(os.path.join(fulldirname, 'build.json'), 'w') as f:
-        f.write(util.toJson(build_info))
+    write(os.path.join(fulldirname, 'build.json'), util.toJson(build_info))
+    return deck
 
-    util.msg("Created deck: %s" % (deck,))
+
+def _writeFile(fn, contents):
+    with open(fn, 'w') as f:
+        f.write(contents)
+
+
+def _writeChanged(fn, contents):
+    if util.getRaw(fn, required=False) != contents:
+        _writeFile(fn, contents)
+
+
+def _copyMedia(path, directory, media_files, copy):
+    util.prepareDir(os.path.join(directory, 'media'))
+    with ThreadPoolExecutor(max_workers=MEDIA_COPY_THREADS) as pool:
+        results = list(
+            pool.map(
+                lambda media_file: copy(
+                    os.path.join(path, 'media', media_file),
+                    os.path.join(directory, 'media', media_file)),
+                media_files))
+    util.count('media files', len(media_files))
+    return results
+
+
+def _copyChanged(src, dst):
+    # Files of the same size are compared by mtime first, which copy2
+    # preserves, and by contents when that differs.
+    if os.path.exists(dst):
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+        if src_stat.st_size == dst_stat.st_size and (
+                src_stat.st_mtime_ns == dst_stat.st_mtime_ns or
+                util.hashFile(src) == util.hashFile(dst)):
+            return False
+    shutil.copy2(src, dst)
+    return True
+
+
+def _checkModels(deck_data):
+    if len(deck_data['deck_configurations']) > 1 or len(
+            deck_data['note_models']) > 1:
+        util.err("Multiple models or configurations per deck is not supported")
+
+    if len(deck_data['deck_configurations']) == 0 or len(
+            deck_data['note_models']) == 0:
+        util.err(
+            "Decks with empty models or configurations are note supported.  Try adding one card in your deck."
+        )
+
+
+def _noteRows(model, notes, model_uuid):
+    # Returns the header and a generator of the rows of the notes, whose
+    # guids are encoded in batches as the rows are consumed.
+    field_list = [v['name'] for v in model['flds']]
+    header = ['guid'] + field_list + ['tags']
+
+    def rows(notes):
+        while True:
+            batch = list(islice(notes, GUID_BATCH))
+            if not batch:
+                break
+            guids = util.guidEncodeColumn([note['guid'] for note in batch],
+                                          model_uuid)
+            util.count('rows', len(batch))
+            for guid, note in zip(guids, batch):
+                row = [guid]
+
+                for i, field in enumerate(field_list):
+                    row.append(note['fields'][i])
+                row.append(' '.join(note['tags']))
+
+                yield row
+
+    return header, rows(iter(notes))
+
+
+def _writeCsv(csvfn, header, rows):
+    try:
+        with open(csvfn, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    except PermissionError:
+        util.err("Cannot write to file: %s" % (csvfn,))
+
+
+def _mergeCsv(csvfns, model, notes, model_uuid, deck, lang=None,
+              delete=False):
+    # Rows are matched to notes by the guid a build gives them.  A data file
+    # is only rewritten when its notes were inserted, updated or deleted;
+    # columns which aren't part of the note model are kept as they are.  The
+    # export of a translation is written to the columns its build read,
+    # the translated ones where they exist; given a 'lang', the export has to
+    # match that language.  With sharded data new notes go
+    # to the last shard.  A note store is rewritten in one transaction.
+    field_list = [v['name'] for v in model['flds']]
+    files = []
+    headers = []
+    for csvfn in csvfns:
+        if notestore.isStore(csvfn):
+            header, rows = notestore.readRows(csvfn)
+        else:
+            with open(csvfn, newline='') as csvfile:
+                reader = csv.reader(csvfile)
+                header = next(reader)
+                rows = list(reader)
+
+        if 'guid' not in header:
+            util.err("Missing 'guid' column in '%s'" % (csvfn,))
+        headers.append((csvfn, header, rows))
+
+    export_lang, model_uuid = _exportLanguage(
+        [header for _, header, _ in headers], model.get('crowdanki_uuid'),
+        model_uuid, deck)
+    if lang is not None and export_lang != lang:
+        util.err("The export of deck '%s' is named for language %s but was built for %s."
+                 % (deck, lang, export_lang))
+    lang = export_lang
+    existing = set(name for _, header, _ in headers for name in header)
+    targets = [
+        '%s:%s' % (column, lang) if '%s:%s' %
+        (column, lang) in existing else column
+        for column in field_list + ['tags']
+    ]
+    for csvfn, header, rows in headers:
+        changed = False
+        for column in targets:
+            if column not in header:
+                header.append(column)
+                changed = True
+        files.append(
+            dict(fn=csvfn,
+                 header=header,
+                 rows=rows,
+                 changed=changed,
+                 width=len(header),
+                 guid_column=header.index('guid'),
+                 columns=[header.index(column) for column in targets]))
+
+    indexed = [(k, i)
+               for k, f in enumerate(files)
+               for i, row in enumerate(f['rows'])
+               if len(row) > f['guid_column'] and row[f['guid_column']]]
+    index = dict(
+        zip(
+            util.guidDecodeColumn([
+                files[k]['rows'][i][files[k]['guid_column']]
+                for k, i in indexed
+            ], model_uuid), indexed))
+
+    seen = set()
+    inserted = []
+    updated = 0
+    notes = iter(notes)
+    while True:
+        batch = list(islice(notes, GUID_BATCH))
+        if not batch:
+            break
+        new_notes = []
+        for note in batch:
+            cells = [note['fields'][i] for i in range(len(field_list))]
+            cells.append(' '.join(note['tags']))
+            position = index.get(note['guid'])
+            if position is None:
+                new_notes.append((note['guid'], cells))
+                continue
+            seen.add(position)
+            f = files[position[0]]
+            row = f['rows'][position[1]]
+            if len(row) < f['width']:
+                row.extend([''] * (f['width'] - len(row)))
+            if [row[c] for c in f['columns']] != cells:
+                for c, cell in zip(f['columns'], cells):
+                    row[c] = cell
+                f['changed'] = True
+                updated += 1
+
+        guids = util.guidInvertColumn([guid for guid, _ in new_notes],
+                                      model_uuid)
+        f = files[-1]
+        for guid, (_, cells) in zip(guids, new_notes):
+            row = [''] * f['width']
+            row[f['guid_column']] = guid
+            for c, cell in zip(f['columns'], cells):
+                row[c] = cell
+            inserted.append(row)
+        util.count('rows', len(batch))
+
+    missing = set(indexed) - seen
+    deleted = missing if delete else set()
+    files[-1]['rows'].extend(inserted)
+    files[-1]['changed'] = files[-1]['changed'] or bool(inserted)
+    deleted_from = set(k for k, _ in deleted)
+    for k, f in enumerate(files):
+        if f['changed'] or k in deleted_from:
+            _replaceCsv(f['fn'], f['header'], [
+                row for i, row in enumerate(f['rows'])
+                if (k, i) not in deleted
+            ])
+    return dict(lang=lang,
+                inserted=len(inserted),
+                updated=updated,
+                deleted=len(deleted),
+                missing=len(missing) - len(deleted))
+
+
+def _exportLanguage(headers, export_uuid, model_uuid, deck):
+    # Returns the language an export was built for and the model uuid its
+    # guids were encoded with, found among the languages of the data files.
+    langs = sorted(
+        set(
+            util.fieldLang(name)[1]
+            for header in headers
+            for name in header) - {'default'})
+    if export_uuid == model_uuid:
+        return 'default', model_uuid
+    matches = [
+        lang for lang in langs if util.uuidEncode(model_uuid, lang) == export_uuid
+    ]
+    if not matches:
+        util.err("The note model of the export doesn't match deck '%s' in any language."
+                 % (deck,))
+    if len(matches) > 1:
+        util.err("The export of deck '%s' could have been built for any of the languages %s."
+                 % (deck, ', '.join(matches)))
+    return matches[0], export_uuid
+
+
+def _replaceCsv(csvfn, header, rows):
+    if notestore.isStore(csvfn):
+        notestore.writeRows(csvfn, header, rows)
+        return
+    fd, tmpfn = tempfile.mkstemp(prefix='.data.csv.',
+                                 dir=os.path.dirname(csvfn) or '.')
+    try:
+        with open(fd, 'w', newline='') as tmpfile:
+            writer = csv.writer(tmpfile)
+            writer.writerow(header)
+            writer.writerows(rows)
+        shutil.copymode(csvfn, tmpfn)
+        os.replace(tmpfn, csvfn)
+    except PermissionError:
+        util.err("Cannot write to file: %s" % (csvfn,))
+    finally:
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
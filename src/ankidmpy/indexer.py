@@ -1,38 +1,105 @@
+import ankidmpy.notestore as notestore
 import ankidmpy.util as util
+from itertools import chain
 import csv
 import os.path
+import shutil
+import tempfile
+
+GUID_BATCH = 1024
 
 
 def indexIt(full, base):
-    filenm = os.path.join(base, 'data.csv')
+    fns = util.getDataFiles(base)
+    assign = _guidAssigner(full)
+
+    if notestore.isStore(fns[0]):
+        # Guids are updated in place, in one transaction.
+        rows, reassigned = notestore.updateGuids(fns[0], assign)
+        util.count('rows', rows)
+        util.count('guids assigned', reassigned)
+        util.msg(
+            "Successfully reindexed 'data.sqlite': %d of %d rows got a new guid."
+            % (reassigned, rows))
+        return
+
+    rows = reassigned = rewritten = 0
+    for filenm in fns:
+        file_rows, file_reassigned = _indexFile(filenm, assign)
+        rows += file_rows
+        reassigned += file_reassigned
+        rewritten += 1 if file_reassigned else 0
+
+    util.count('rows', rows)
+    util.count('guids assigned', reassigned)
+    if fns == [os.path.join(base, 'data.csv')]:
+        util.msg(
+            "Successfully reindexed 'data.csv': %d of %d rows got a new guid."
+            % (reassigned, rows))
+    else:
+        util.msg(
+            "Successfully reindexed 'data': %d of %d rows got a new guid, %d of %d shards were rewritten."
+            % (reassigned, rows, rewritten, len(fns)))
+
+
+def _guidAssigner(full):
+    # Returns a function which is called with the guids of all rows in order
+    # and returns the new guid of a row, or None when it keeps its own.
+    # Guids are unique across all shards, the first row using one keeps it.
+    guids = set()
+    new_guids = chain.from_iterable(
+        iter(lambda: util.createGuids(GUID_BATCH), None))
+
+    def assign(guid):
+        if guid and guid not in guids and not full:
+            guids.add(guid)
+            return None
+        guid = next(new_guids)
+        while guid in guids:
+            guid = next(new_guids)
+        guids.add(guid)
+        return guid
+
+    return assign
+
+
+def _indexFile(filenm, assign):
+    # Rows are streamed into a temporary file next to the original which
+    # then replaces it, so an interrupted run leaves the original untouched.
+    # Files in which no guid changed are left alone.
+    directory, basename = os.path.split(filenm)
+    fd, tmpfn = tempfile.mkstemp(prefix='.%s.' % (basename,),
+                                 dir=directory or '.')
+    rows = reassigned = 0
     try:
-        with open(filenm, newline='') as csvfile:
+        with open(filenm, newline='') as csvfile, open(
+                fd, 'w', newline='') as tmpfile:
             reader = csv.reader(csvfile)
             header = next(reader)
             guid_column = None
             try:
                 guid_column = header.index('guid')
             except ValueError:
-                util.err("Missing 'guid' column")
-            data = list(reader)
-    except PermissionError:
-        util.err("Cannot read file: %s" % (filenm,))
+                util.err("Missing 'guid' column in '%s'" % (filenm,))
 
-    guids = []
-    try:
-        with open(filenm, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
+            writer = csv.writer(tmpfile)
             writer.writerow(header)
-            for row in data:
-                guid = row[guid_column]
-                if not guid or (guid in guids) or full:
-                    guid = util.createGuid()
-                guids.append(guid)
-                # FIXME: I'm assuming we're supposed to use the guid
-                # row[guid_column] = guid
+            for row in reader:
+                if len(row) <= guid_column:
+                    row += [''] * (guid_column + 1 - len(row))
+                guid = assign(row[guid_column])
+                if guid is not None:
+                    row[guid_column] = guid
+                    reassigned += 1
                 writer.writerow(row)
+                rows += 1
 
+        if reassigned:
+            shutil.copymode(filenm, tmpfn)
+            os.replace(tmpfn, filenm)
     except PermissionError:
         util.err("Cannot write to file: %s" % (filenm,))
-
-    util.msg("Successfully reindexed 'data.csv'")
+    finally:
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
+    return rows, reassigned
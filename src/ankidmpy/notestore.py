@@ -0,0 +1,238 @@
+import ankidmpy.util as util
+from contextlib import contextmanager
+from itertools import islice
+import csv
+import os.path
+import sqlite3
+
+# An alternative to data.csv for big deck sets: the notes are kept in a
+# SQLite database, 'data.sqlite', so that commands can update them in place
+# instead of rewriting the whole file.  The 'columns' table keeps the
+# columns of data.csv in order, guid and tags included, and 'field_values'
+# the other cells of every note.
+
+STORE_FILE = 'data.sqlite'
+SCHEMA_VERSION = 1
+BATCH_SIZE = 10000
+
+SCHEMA = """
+CREATE TABLE columns (
+    position INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    field TEXT NOT NULL,
+    lang TEXT NOT NULL
+);
+CREATE TABLE notes (
+    id INTEGER PRIMARY KEY,
+    guid TEXT NOT NULL,
+    tags TEXT NOT NULL
+);
+CREATE INDEX notes_guid ON notes (guid);
+CREATE TABLE note_tags (
+    tag TEXT NOT NULL,
+    note INTEGER NOT NULL,
+    PRIMARY KEY (tag, note)
+) WITHOUT ROWID;
+CREATE TABLE field_values (
+    note INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (note, position)
+) WITHOUT ROWID;
+"""
+
+
+def storeFile(base):
+    return os.path.join(base, STORE_FILE)
+
+
+def isStore(fn):
+    return os.path.basename(fn) == STORE_FILE
+
+
+def writeRows(fn, header, rows):
+    # Replaces the notes in the store, which is created if needed, with
+    # 'rows' in one transaction.  Rows are inserted in batches as they come.
+    if 'guid' not in header:
+        util.err("Missing 'guid' column")
+    guid_column = header.index('guid')
+    tags_column = header.index('tags') if 'tags' in header else None
+    positions = [
+        i for i in range(len(header)) if i not in (guid_column, tags_column)
+    ]
+
+    db = _connect(fn, create=True)
+    try:
+        with db:
+            for table in ('columns', 'notes', 'note_tags', 'field_values'):
+                db.execute('DELETE FROM %s' % (table,))
+            db.executemany('INSERT INTO columns VALUES (?, ?, ?, ?)',
+                           [(i, name) + util.fieldLang(name)
+                            for i, name in enumerate(header)])
+            note = 0
+            rows = iter(rows)
+            while True:
+                batch = list(islice(rows, BATCH_SIZE))
+                if not batch:
+                    break
+                batch = [
+                    row if len(row) >= len(header) else row + [''] *
+                    (len(header) - len(row)) for row in batch
+                ]
+                db.executemany(
+                    'INSERT INTO notes VALUES (?, ?, ?)',
+                    [(note + k, row[guid_column],
+                      row[tags_column] if tags_column is not None else '')
+                     for k, row in enumerate(batch)])
+                if tags_column is not None:
+                    db.executemany(
+                        'INSERT INTO note_tags VALUES (?, ?)',
+                        [(tag, note + k)
+                         for k, row in enumerate(batch)
+                         for tag in set(row[tags_column].split(' '))
+                         if tag])
+                db.executemany('INSERT INTO field_values VALUES (?, ?, ?)',
+                               [(note + k, i, row[i])
+                                for k, row in enumerate(batch)
+                                for i in positions])
+                note += len(batch)
+    finally:
+        db.close()
+    util.count('rows', note)
+    return note
+
+
+@contextmanager
+def openRows(fn):
+    # Yields the header and an iterator over the rows of the store, as
+    # data.csv would have them, read through a cursor.
+    db = _connect(fn)
+    try:
+        header = _header(db)
+        yield header, _iterRows(db, header)
+    finally:
+        db.close()
+
+
+def readRows(fn):
+    with openRows(fn) as (header, rows):
+        return header, list(rows)
+
+
+def readColumns(fn, project=None):
+    # Returns the header and the columns of the store, like util.readCsv.
+    # Only the values of the columns kept by 'project' are read.
+    db = _connect(fn)
+    try:
+        header = _header(db)
+        positions = util.projectHeader(header, project)
+        return header, util.rowsToColumns(
+            _iterRows(db, header, positions if project is not None else None),
+            len(header), BATCH_SIZE, positions)
+    finally:
+        db.close()
+
+
+def updateGuids(fn, assign):
+    # Calls assign(guid) with the guid of every note in order and stores
+    # the ones it returns instead, in one transaction.  Returns the number
+    # of notes and of changed guids.
+    db = _connect(fn)
+    try:
+        with db:
+            notes = db.execute('SELECT id, guid FROM notes ORDER BY id'
+                              ).fetchall()
+            updates = []
+            for note, guid in notes:
+                guid = assign(guid)
+                if guid is not None:
+                    updates.append((guid, note))
+            db.executemany('UPDATE notes SET guid = ? WHERE id = ?', updates)
+    finally:
+        db.close()
+    return len(notes), len(updates)
+
+
+def exportCsv(base, fn):
+    # Writes the notes of the deck set's store to the CSV file fn.
+    store = storeFile(base)
+    if not os.path.exists(store):
+        util.err("Cannot find note store: %s" % (store,))
+    with openRows(store) as (header, rows), open(fn, 'w',
+                                                 newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(header)
+        count = 0
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    util.count('rows', count)
+    util.msg("Exported %d notes to '%s'." % (count, fn))
+
+
+def importCsv(base, fn):
+    # Replaces the notes of the deck set's store, creating it if needed,
+    # with those of the CSV file fn.
+    data_files = util.getDataFiles(base)
+    if not isStore(data_files[0]) and os.path.exists(data_files[0]):
+        util.err("The deck set '%s' keeps its notes in CSV files, move them out first."
+                 % (base,))
+    with open(fn, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        count = writeRows(storeFile(base), next(reader), reader)
+    util.msg("Imported %d notes into '%s'." % (count, storeFile(base)))
+
+
+def _connect(fn, create=False):
+    if not create and not os.path.exists(fn):
+        util.err("Cannot find note store: %s" % (fn,))
+    db = sqlite3.connect(fn)
+    try:
+        version, = db.execute('PRAGMA user_version').fetchone()
+        if version == 0 and create:
+            db.executescript(SCHEMA)
+            db.execute('PRAGMA user_version = %d' % (SCHEMA_VERSION,))
+        elif version != SCHEMA_VERSION:
+            util.err("Unsupported note store version %d in '%s'." %
+                     (version, fn))
+    except sqlite3.Error as e:
+        db.close()
+        util.err("Cannot open note store '%s': %s" % (fn, e))
+    except RuntimeError:
+        db.close()
+        raise
+    return db
+
+
+def _header(db):
+    return [
+        name
+        for name, in db.execute('SELECT name FROM columns ORDER BY position')
+    ]
+
+
+def _iterRows(db, header, positions=None):
+    # Only the values at 'positions' are read when it's given, the other
+    # cells are left empty.
+    guid_column = header.index('guid')
+    tags_column = header.index('tags') if 'tags' in header else None
+    if positions is None:
+        values = db.execute('SELECT note, position, value FROM field_values '
+                            'ORDER BY note, position')
+    else:
+        values = db.execute(
+            'SELECT note, position, value FROM field_values '
+            'WHERE position IN (%s) ORDER BY note, position' %
+            (', '.join('%d' % (i,) for i in positions),))
+    value = next(values, None)
+    for note, guid, tags in db.execute(
+            'SELECT id, guid, tags FROM notes ORDER BY id'):
+        row = [''] * len(header)
+        row[guid_column] = guid
+        if tags_column is not None:
+            row[tags_column] = tags
+        while value is not None and value[0] <= note:
+            if value[0] == note:
+                row[value[1]] = value[2]
+            value = next(values, None)
+        yield row
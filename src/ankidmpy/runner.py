@@ -1,20 +1,24 @@
-import ankidmpy.builder as builder
-import ankidmpy.copier as copier
-import ankidmpy.indexer as indexer
-import ankidmpy.util as util
-import ankidmpy.importer as importer
-import os.path
 import argparse
+import os.path
 import sys
 
+# Subcommand modules are imported by the commands that need them, so that
+# '--help' and argument errors don't pay for loading them.
+
 DIRNAME, _ = os.path.split(__file__)
 TEMPLATES_DIR = os.path.abspath(os.path.join(DIRNAME, 'templates'))
-templates = util.getFilesList(TEMPLATES_DIR, 'dir')
+
+
+def listTemplates():
+    import ankidmpy.util as util
+    return util.getFilesList(TEMPLATES_DIR, 'dir')
 
 
 def initDeck(args):
+    import ankidmpy.importer as importer
+    import ankidmpy.util as util
     template = args.template
-    if not template in templates:
+    if not template in listTemplates():
         util.err('Cannot find template: %s' % (template,))
 
     util.prepareDir(args.base)
@@ -23,30 +27,170 @@ def initDeck(args):
         util.err("Directory '%s' is not empty." % (args.base,))
 
     importer.importIt(os.path.join(TEMPLATES_DIR, template), args.base,
-                      args.deck)
+                      args.deck, args.sqlite)
 
 
 def importDeck(args):
+    import ankidmpy.importer as importer
+    import ankidmpy.util as util
+    if args.merge:
+        importer.mergeIt(args.path, args.base, args.deck, args.delete)
+        return
+
     util.prepareDir(args.base)
 
     if not util.isDirEmpty(args.base):
         util.err("Directory '%s' is not empty." % (args.base,))
 
-    importer.importIt(args.path, args.base, args.deck)
+    importer.importIt(args.path, args.base, args.deck, args.sqlite)
 
 
 def buildDeck(args):
-    builder.build(args.deck, args.base, args.build, args.lang)
+    import ankidmpy.builder as builder
+    builder.build(args.deck, args.base, args.build, args.lang, args.jobs,
+                  args.force, args.media_mode, args.media_store,
+                  args.io_threads, args.io_queue, args.archive, args.where,
+                  args.compact)
+
+
+def buildAllDecks(args):
+    import ankidmpy.builder as builder
+    summary = builder.buildAll(args.bases, args.build, args.lang, args.jobs,
+                               args.force, args.media_mode, args.media_store,
+                               args.io_threads, args.io_queue, args.archive,
+                               args.where, args.compact)
+    if summary['failed']:
+        sys.exit(1)
+
+
+def watchDeck(args):
+    import ankidmpy.watcher as watcher
+    watcher.watch(args.deck, args.base, args.build, args.lang, args.interval,
+                  args.jobs, args.media_mode, args.media_store,
+                  args.io_threads, args.io_queue, args.archive, args.where,
+                  args.compact)
 
 
 def indexDeck(args):
+    import ankidmpy.indexer as indexer
     indexer.indexIt(args.full, args.base)
 
 
+def exportCsv(args):
+    import ankidmpy.notestore as notestore
+    notestore.exportCsv(args.base, args.file)
+
+
+def importCsv(args):
+    import ankidmpy.notestore as notestore
+    notestore.importCsv(args.base, args.file)
+
+
 def copyDeck(args):
+    import ankidmpy.copier as copier
     copier.copy(args.deck1, args.deck2, args.base)
 
 
+def _addDeckArgument(parser):
+    parser.add_argument(
+        'deck',
+        nargs='*',
+        help=
+        'Decks to build. If not specified then all decks of the deck set will be built.'
+    )
+
+
+def _addBuildArguments(parser):
+    parser.add_argument(
+        '--lang',
+        dest='lang',
+        help='''Build decks for the specific language code.  
+                          If omitted then decks for all languages will be built.'''
+    )
+    parser.add_argument('--build',
+                        dest='build',
+                        help='''Path to the build directory.
+                          [Default: build]''')
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        dest='jobs',
+        type=int,
+        default=1,
+        help='''Number of worker processes building (deck, language) pairs
+                          in parallel.  [Default: 1]''')
+    parser.add_argument(
+        '--media-mode',
+        dest='media_mode',
+        choices=('copy', 'hardlink', 'symlink', 'reflink'),
+        default='copy',
+        help='''How to place media files in the built decks.  Falls back to
+                          copying when the filesystem can't link.  [Default: copy]'''
+    )
+    parser.add_argument(
+        '--media-store',
+        dest='media_store',
+        action='store_true',
+        help='''Keep one content-addressed copy of every media file under
+                          the build directory and place the decks' media from
+                          there.''')
+    parser.add_argument(
+        '--archive',
+        dest='archive',
+        choices=('zip', 'tar.gz'),
+        help='''Write every deck straight into a '<deck>.zip' or
+                          '<deck>.tar.gz' archive in the build directory instead
+                          of a directory.''')
+    parser.add_argument(
+        '--compact',
+        dest='compact',
+        action='store_true',
+        help='''Write the deck JSON without indentation or whitespace, for
+                          tools rather than people to read.''')
+    parser.add_argument(
+        '--where',
+        dest='where',
+        metavar='EXPRESSION',
+        help='''Only build the notes selected by EXPRESSION, such as
+                          'tag:core and not tag:draft' or '"Field 1"!=""'.
+                          'tag:NAME' selects tagged notes, FIELD=VALUE and
+                          FIELD!=VALUE compare fields, a FIELD on its own
+                          selects notes where it isn't empty; combine them
+                          with and, or, not and parentheses.''')
+    parser.add_argument(
+        '--io-threads',
+        dest='io_threads',
+        type=int,
+        default=4,
+        help='''Number of threads writing deck files and placing media
+                          while the next deck is assembled.  [Default: 4]''')
+    parser.add_argument(
+        '--io-queue',
+        dest='io_queue',
+        type=int,
+        default=8,
+        help='''Maximum number of I/O jobs, and of 1 MiB chunks of a
+                          deck file, waiting for the I/O threads.  [Default: 8]'''
+    )
+
+
+def _addForceArgument(parser):
+    parser.add_argument(
+        '--force',
+        dest='force',
+        action='store_true',
+        help='''Rebuild every deck and copy every media file even if the
+                          build manifest says they are up to date.''')
+
+
+def _addSqliteArgument(parser):
+    parser.add_argument('--sqlite',
+                        dest='sqlite',
+                        action='store_true',
+                        help='''Keep the notes in a SQLite note store,
+                          'data.sqlite', instead of 'data.csv'.''')
+
+
 def parse_arguments():
     DESCRIPTION = """
     This tool disassembles CrowdAnki decks into collections of files
@@ -70,6 +214,7 @@ def parse_arguments():
         help='''Name of the default deck of the deck set being created.
                           If not provided, then the original deck/template name will be used.'''
     )
+    _addSqliteArgument(parser_init)
     parser_init.set_defaults(command=initDeck)
 
     parser_import = subparsers.add_parser(
@@ -82,28 +227,59 @@ def parse_arguments():
         help='''Name of the default deck of the deck set being created.
                           If not provided, then the original deck/template name will be used.'''
     )
+    parser_import.add_argument(
+        '--merge',
+        dest='merge',
+        action='store_true',
+        help='''Merge a newer export of a deck into the existing deck set:
+                          notes are inserted and updated by guid, only new or
+                          changed media is copied and the deck's uuids are
+                          kept.  The export of a translated deck is merged
+                          into the columns of its language.''')
+    parser_import.add_argument(
+        '--delete',
+        dest='delete',
+        action='store_true',
+        help='''With --merge, delete the notes missing from the export.  Don't
+                          use it for decks built with --where, which only hold
+                          some of the notes.''')
+    _addSqliteArgument(parser_import)
     parser_import.set_defaults(command=importDeck)
 
     parser_build = subparsers.add_parser(
         'build', help="Build Anki-dm deck into CrowdAnki format")
-    parser_build.add_argument(
-        'deck',
-        nargs='*',
-        help=
-        'Decks to build. If not specified then all decks of the deck set will be built.'
-    )
-    parser_build.add_argument(
-        '--lang',
-        dest='lang',
-        help='''Build decks for the specific language code.  
-                          If omitted then decks for all languages will be built.'''
-    )
-    parser_build.add_argument('--build',
-                              dest='build',
-                              help='''Path to the build directory.
-                          [Default: build]''')
+    _addDeckArgument(parser_build)
+    _addBuildArguments(parser_build)
+    _addForceArgument(parser_build)
     parser_build.set_defaults(command=buildDeck)
 
+    parser_build_all = subparsers.add_parser(
+        'build-all',
+        help="Build all decks of several deck sets with one pool of workers."
+    )
+    parser_build_all.add_argument(
+        'bases',
+        nargs='+',
+        metavar='base',
+        help='''Deck set directories, or glob patterns matching them.  Each
+                          deck set is built into a directory named after it
+                          under the build directory.''')
+    _addBuildArguments(parser_build_all)
+    _addForceArgument(parser_build_all)
+    parser_build_all.set_defaults(command=buildAllDecks)
+
+    parser_watch = subparsers.add_parser(
+        'watch', help="Rebuild decks whenever their sources change.")
+    _addDeckArgument(parser_watch)
+    _addBuildArguments(parser_watch)
+    parser_watch.add_argument(
+        '--interval',
+        dest='interval',
+        type=float,
+        default=0.5,
+        help='Seconds between checks for changed sources.  [Default: 0.5]')
+    parser_watch.set_defaults(command=watchDeck)
+
     parser_copy = subparsers.add_parser(
         'copy', help='Make reindexed copy of Anki-dm deck.')
     parser_copy.add_argument('deck1', help="Source deck")
@@ -123,15 +299,47 @@ def parse_arguments():
                               help='Reindex all data rows.')
     parser_index.set_defaults(command=indexDeck)
 
+    parser_export_csv = subparsers.add_parser(
+        'export-csv', help="Write the notes of the note store to a CSV file.")
+    parser_export_csv.add_argument('file', help='CSV file to write.')
+    parser_export_csv.set_defaults(command=exportCsv)
+
+    parser_import_csv = subparsers.add_parser(
+        'import-csv',
+        help="Replace the notes of the note store with those of a CSV file.")
+    parser_import_csv.add_argument('file', help='CSV file to read.')
+    parser_import_csv.set_defaults(command=importCsv)
+
     parser.add_argument('--base',
                         dest='base',
                         default=".",
                         help='''Path to the deck set directory.
                           [Default: src]''')
+    parser.add_argument('--no-cache',
+                        dest='cache',
+                        action='store_false',
+                        help='''Don't read or write the parsed sources cached
+                          in '.anki-dm-cache' under the deck set directory.''')
+    parser.add_argument('--cache-size',
+                        dest='cache_size',
+                        type=int,
+                        metavar='MIB',
+                        default=256,
+                        help='''Size of the source cache in MiB.  Sources that
+                          don't fit aren't cached.  [Default: 256]''')
     parser.add_argument('--templates',
                         dest='templates',
                         action='store_true',
                         help='List all available templates.')
+    parser.add_argument('--timings',
+                        dest='timings',
+                        action='store_true',
+                        help='''Print the wall and CPU time spent per phase
+                          and deck, and counters, to stderr.''')
+    parser.add_argument('--timings-json',
+                        dest='timings_json',
+                        metavar='FILE',
+                        help='Write the same timings as JSON to FILE.')
 
     return parser.parse_args()
 
@@ -140,12 +348,29 @@ def main():
 
     args = parse_arguments()
 
+    import ankidmpy.util as util
+
     if args.templates:
+        templates = listTemplates()
         if len(templates):
             util.msg('\n'.join(templates))
             sys.exit(0)
         else:
             util.err("No templates found")
 
+    import ankidmpy.sourcecache as sourcecache
+    sourcecache.setEnabled(args.cache)
+    sourcecache.setMaxBytes(args.cache_size * 1024 * 1024)
+
+    if args.timings or args.timings_json:
+        util.enableTimings()
+
     if args.command:
-        args.command(args)
+        try:
+            with util.timed('total'):
+                args.command(args)
+        finally:
+            if args.timings:
+                util.reportTimings()
+            if args.timings_json:
+                util.reportTimings(args.timings_json)
@@ -0,0 +1,143 @@
+import ankidmpy.util as util
+import re
+
+# Row selection expressions, such as
+#
+#     tag:core and not tag:draft
+#     "Field 1"!="" or (Sound and Level=easy)
+#
+# 'tag:NAME' selects the rows tagged NAME, 'FIELD=VALUE' and 'FIELD!=VALUE'
+# compare a field, and a FIELD on its own selects the rows where it isn't
+# empty.  Names and values with spaces or operators in them are quoted.
+# Fields are looked up in the language being built.
+
+TOKEN_RE = re.compile(r'\s*(?:(\(|\)|!=|=)|"((?:[^"\\]|\\.)*)"|([^\s()=!"]+))')
+KEYWORDS = ('and', 'or', 'not')
+
+
+def parse(expression):
+    # Returns the expression as a tree of tuples.
+    tokens = _tokenize(expression)
+    tree = _parseOr(tokens, expression)
+    if tokens:
+        _syntaxError(expression, "unexpected '%s'" % (tokens[0][1],))
+    return tree
+
+
+def fields(tree):
+    # The fields whose indexes the expression uses.
+    if tree[0] in ('and', 'or'):
+        return fields(tree[1]) | fields(tree[2])
+    if tree[0] == 'not':
+        return fields(tree[1])
+    if tree[0] == 'tag':
+        return {'tags'}
+    return {tree[1]}
+
+
+def select(data, tree):
+    # Returns views of the selected rows of every language of 'data'.
+    # Languages that select the same rows share the copies of the columns.
+    selected = dict()
+    copies = dict()
+    result = dict()
+    for lang, view in data.items():
+        rows = sorted(_evaluate(tree, view))
+        rows = selected.setdefault(tuple(rows), rows)
+        util.count('selected rows', len(rows))
+        result[lang] = view.select(rows, copies)
+    return result
+
+
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+        if not match:
+            _syntaxError(expression,
+                         "unexpected '%s'" % (expression[position:].strip(),))
+        operator, quoted, word = match.groups()
+        if operator:
+            tokens.append(('op', operator))
+        elif quoted is not None:
+            tokens.append(('name', re.sub(r'\\(.)', r'\1', quoted)))
+        elif word in KEYWORDS:
+            tokens.append(('op', word))
+        elif word.startswith('tag:') and len(word) > 4:
+            tokens.append(('tag', word[4:]))
+        else:
+            tokens.append(('name', word))
+        position = match.end()
+    return tokens
+
+
+def _parseOr(tokens, expression):
+    tree = _parseAnd(tokens, expression)
+    while tokens and tokens[0] == ('op', 'or'):
+        tokens.pop(0)
+        tree = ('or', tree, _parseAnd(tokens, expression))
+    return tree
+
+
+def _parseAnd(tokens, expression):
+    tree = _parseNot(tokens, expression)
+    while tokens and tokens[0] == ('op', 'and'):
+        tokens.pop(0)
+        tree = ('and', tree, _parseNot(tokens, expression))
+    return tree
+
+
+def _parseNot(tokens, expression):
+    if not tokens:
+        _syntaxError(expression, 'unexpected end')
+    kind, value = tokens.pop(0)
+    if (kind, value) == ('op', 'not'):
+        return ('not', _parseNot(tokens, expression))
+    if (kind, value) == ('op', '('):
+        tree = _parseOr(tokens, expression)
+        if not tokens or tokens.pop(0) != ('op', ')'):
+            _syntaxError(expression, "missing ')'")
+        return tree
+    if kind == 'tag':
+        return ('tag', value)
+    if kind != 'name':
+        _syntaxError(expression, "unexpected '%s'" % (value,))
+    if tokens and tokens[0] in (('op', '='), ('op', '!=')):
+        _, operator = tokens.pop(0)
+        if not tokens or tokens[0][0] == 'op':
+            _syntaxError(expression, "missing value after '%s'" % (operator,))
+        kind, operand = tokens.pop(0)
+        return (operator, value,
+                'tag:' + operand if kind == 'tag' else operand)
+    return ('set', value)
+
+
+def _syntaxError(expression, problem):
+    util.err("Invalid --where expression '%s': %s." % (expression, problem))
+
+
+def _evaluate(tree, view):
+    # Returns the set of the numbers of the selected rows.
+    operator = tree[0]
+    if operator == 'and':
+        return _evaluate(tree[1], view) & _evaluate(tree[2], view)
+    if operator == 'or':
+        return _evaluate(tree[1], view) | _evaluate(tree[2], view)
+    if operator == 'not':
+        return set(range(view.rowCount())) - _evaluate(tree[1], view)
+    if operator == 'tag':
+        if 'tags' not in view:
+            return set()
+        return set(view.index('tags').get(tree[1], ()))
+
+    field = tree[1]
+    if field not in view:
+        util.err("Column '%s' is missing in 'data.csv'." % (field,))
+    if operator == '=':
+        return set(view.index(field).get(tree[2], ()))
+    if operator == '!=':
+        return set(range(view.rowCount())) - set(
+            view.index(field).get(tree[2], ()))
+    return set(range(view.rowCount())) - set(view.index(field).get('', ()))
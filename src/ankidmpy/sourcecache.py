@@ -0,0 +1,187 @@
+import ankidmpy.util as util
+import hashlib
+import marshal
+import os.path
+import struct
+
+CACHE_DIR = '.anki-dm-cache'
+CACHE_VERSION = 1
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+HEADER_SIZE = struct.Struct('<Q')
+
+# 'off' bypasses the cache, 'read' reuses entries without ever writing any
+# and 'write' both reads and writes them.
+MODES = ('off', 'read', 'write')
+
+_enabled = True
+_max_bytes = CACHE_MAX_BYTES
+
+
+def setEnabled(enabled):
+    global _enabled
+    _enabled = enabled
+
+
+def isEnabled():
+    return _enabled
+
+
+def setMaxBytes(max_bytes):
+    global _max_bytes
+    _max_bytes = max_bytes
+
+
+def maxBytes():
+    return _max_bytes
+
+
+def load(base, kind, source, paths, loader, mode='write'):
+    # Returns loader() for the files in 'paths', reusing the result stored
+    # under 'base' by an earlier call.  An entry stays valid while the files
+    # keep their sizes and mtimes, or, when only the mtimes changed, their
+    # contents.  Values must be plain lists, dicts and strings so that they
+    # can be stored with marshal, which unlike pickle can't run code from a
+    # tampered cache.
+    if _mode(mode) == 'off':
+        return loader()
+
+    # Files changed while the loader reads them don't match what's stored.
+    stats = _stat(paths)
+    value = lookup(base, kind, source, paths, mode)
+    if value is None:
+        value = loader()
+        store(base, kind, source, paths, value, stats, mode)
+    return value
+
+
+def lookup(base, kind, source, paths, mode='write'):
+    # The lookup half of load(): returns the stored value, or None.
+    mode = _mode(mode)
+    if mode == 'off':
+        return None
+
+    stats = _stat(paths)
+    fn = _entryFile(base, kind, source)
+    header, value = _read(fn)
+    if header is not None:
+        if header['stats'] == stats:
+            return _hit(fn, value, mode)
+        if [s[:2] for s in header['stats']] == [s[:2] for s in stats]:
+            if header['digest'] == _digest(paths):
+                if mode == 'write':
+                    _write(fn, dict(header, stats=stats), value)
+                return _hit(fn, value, mode)
+
+    util.count('cache misses')
+    return None
+
+
+def store(base, kind, source, paths, value, stats=None, mode='write'):
+    if _mode(mode) == 'write':
+        _write(
+            _entryFile(base, kind, source),
+            dict(version=CACHE_VERSION,
+                 stats=stats or _stat(paths),
+                 digest=_digest(paths)), value)
+
+
+def _mode(mode):
+    if mode not in MODES:
+        util.err("Unknown source cache mode: %s" % (mode,))
+    return mode if _enabled else 'off'
+
+
+def _entryFile(base, kind, source):
+    key = hashlib.sha256(
+        ('%s\0%s' % (kind, os.path.abspath(source))).encode('utf-8'))
+    return os.path.join(base, CACHE_DIR, key.hexdigest())
+
+
+def _stat(paths):
+    stats = []
+    for path in paths:
+        st = os.stat(path)
+        stats.append([path, st.st_size, st.st_mtime_ns])
+    return stats
+
+
+def _digest(paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(util.hashFile(path).encode('ascii'))
+    return digest.hexdigest()
+
+
+def _hit(fn, value, mode):
+    if mode == 'write':
+        try:
+            # Entries are evicted least recently used first.
+            os.utime(fn)
+        except OSError:
+            pass
+    util.count('cache hits')
+    return value
+
+
+def _read(fn):
+    if not os.path.exists(fn):
+        return None, None
+    with util.timed('cache: read'):
+        try:
+            with open(fn, 'rb') as f:
+                size, = HEADER_SIZE.unpack(f.read(HEADER_SIZE.size))
+                if size > os.fstat(f.fileno()).st_size:
+                    return None, None
+                header = marshal.loads(f.read(size))
+                if header.get('version') != CACHE_VERSION:
+                    return None, None
+                return header, marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError, AttributeError,
+                struct.error):
+            return None, None
+
+
+def _write(fn, header, value):
+    # Entries larger than the whole cache aren't written, as they would be
+    # evicted again straight away.
+    tmp = fn + '.tmp'
+    try:
+        with util.timed('cache: write'):
+            header = marshal.dumps(header)
+            value = marshal.dumps(value)
+            size = HEADER_SIZE.size + len(header) + len(value)
+            if size > _max_bytes:
+                util.count('cache entries too large')
+                util.warn(
+                    "Not caching a source of %d MiB in a cache of %d MiB, see --cache-size."
+                    % (size >> 20, _max_bytes >> 20))
+                return
+            util.prepareDir(os.path.dirname(fn))
+            with open(tmp, 'wb') as f:
+                f.write(HEADER_SIZE.pack(len(header)))
+                f.write(header)
+                f.write(value)
+        os.replace(tmp, fn)
+        _evict(os.path.dirname(fn), keep=os.path.basename(fn))
+    except (OSError, RuntimeError, ValueError) as e:
+        util.warn("Cannot write the source cache: %s" % (e,))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _evict(directory, keep=None, max_bytes=None):
+    # Removes the least recently used entries but 'keep' until the cache
+    # fits in max_bytes.
+    max_bytes = _max_bytes if max_bytes is None else max_bytes
+    entries = []
+    for fn in os.listdir(directory):
+        st = os.stat(os.path.join(directory, fn))
+        entries.append((st.st_mtime, st.st_size, fn))
+    total = sum(size for _, size, _ in entries)
+    for _, size, fn in sorted(entries):
+        if total <= max_bytes:
+            break
+        if fn == keep:
+            continue
+        os.remove(os.path.join(directory, fn))
+        total -= size
@@ -1,13 +1,40 @@
 import csv
+import hashlib
+import html
 import json
+import math
 import re
 from collections import defaultdict
+from collections.abc import Mapping
+from itertools import islice
+from operator import itemgetter
 import uuid
 import random
+import shutil
 import os.path
 import sys
+import time
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from urllib.parse import unquote
 
 GUID_CHARS = 'abcdefghijklmnopqrstuvwxyz' + 'ABCDEFGHIJKLMNOPQRSTUVWXYZ' + '0123456789' + "!#$%&()*+,-./:;<=>?@[]^_`{|}~"
+GUID_INDEX = dict((c, i) for i, c in enumerate(GUID_CHARS))
+UUID_CHARS = frozenset('0123456789abcdef-')
+FILENAME_DISALLOWED_RE = re.compile(r'[^a-zA-Z0-9$\-_ ]')
+
+# Each alternative of the media reference pattern, keyed by a character
+# that any of its matches contains.  No alternative matches a NUL, which
+# getMediaRefs puts between cells.
+MEDIA_REF_BRANCHES = (
+    ('[', r'\[sound:([^\]\0]+)\]'),
+    ('<', r'<(?:img|audio|video|source|embed)\b[^>\0]*?\ssrc\s*=\s*'
+     r'(?:"([^"\0]*)"|\'([^\'\0]*)\'|([^\s>\0]+))'),
+    ('(', r'url\(\s*[\'"]?([^\'")\0]+?)[\'"]?\s*\)'),
+)
+MEDIA_REF_RE = re.compile('|'.join(branch for _, branch in MEDIA_REF_BRANCHES),
+                          re.IGNORECASE)
+MEDIA_REF_SEP = '\0'
 
 
 def prepareDir(directory):
@@ -29,9 +56,251 @@ def warn(msg):
     print(msg, file=sys.stderr)
 
 
-def toJson(data):
-    res = json.dumps(data, indent=2, ensure_ascii=False)
-    return re.sub(r'/^(  +?)\\1(?=[^ ])/m', '\1', res)
+def enableTimings():
+    global _timings
+    _timings = dict(phases=dict(), counters=dict())
+
+
+def timingsEnabled():
+    return _timings is not None
+
+
+@contextmanager
+def timed(phase):
+    if _timings is None:
+        yield
+        return
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        entry = _timings['phases'].setdefault(phase, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += time.perf_counter() - wall
+        entry[2] += time.process_time() - cpu
+
+
+def count(counter, amount=1):
+    if _timings is not None:
+        counters = _timings['counters']
+        counters[counter] = counters.get(counter, 0) + amount
+
+
+def takeTimings():
+    # Returns what has been recorded so far and starts over; used to hand
+    # the timings of worker processes back to the parent.
+    timings = _timings
+    if timings is not None:
+        enableTimings()
+    return timings
+
+
+def mergeTimings(timings):
+    if _timings is None or not timings:
+        return
+    for phase, (calls, wall, cpu) in timings['phases'].items():
+        entry = _timings['phases'].setdefault(phase, [0, 0.0, 0.0])
+        entry[0] += calls
+        entry[1] += wall
+        entry[2] += cpu
+    for counter, amount in timings['counters'].items():
+        count(counter, amount)
+
+
+def reportTimings(fn=None):
+    # Writes the timings as JSON to fn, or as a table to stderr.
+    if _timings is None:
+        return
+    phases = [
+        dict(phase=phase, calls=calls, wall=wall, cpu=cpu)
+        for phase, (calls, wall, cpu) in _timings['phases'].items()
+    ]
+    if fn:
+        with open(fn, 'w') as f:
+            f.write(toJson(dict(phases=phases,
+                                counters=_timings['counters'])))
+        return
+
+    width = max([len(p['phase']) for p in phases] +
+                [len(counter) for counter in _timings['counters']] +
+                [len('phase')])
+    warn('%-*s %7s %10s %10s' % (width, 'phase', 'calls', 'wall', 'cpu'))
+    for p in phases:
+        warn('%-*s %7d %9.3fs %9.3fs' %
+             (width, p['phase'], p['calls'], p['wall'], p['cpu']))
+    for counter, amount in _timings['counters'].items():
+        warn('%-*s %7d' % (width, counter, amount))
+
+
+_timings = None
+
+
+JSON_BACKENDS = ('orjson', 'json')
+
+_json_backend = None
+
+
+def setJsonBackend(name=None):
+    # Picks the encoder toJson uses: 'name', or the first of JSON_BACKENDS
+    # that can be imported.  Every backend writes the same text.
+    global _json_backend
+    for backend in JSON_BACKENDS if name is None else (name,):
+        if backend == 'json':
+            _json_backend = ('json', None)
+            return backend
+        if backend == 'orjson':
+            try:
+                import orjson
+            except ImportError:
+                if name is None:
+                    continue
+                err("The JSON backend 'orjson' is not installed.")
+            _json_backend = ('orjson', orjson)
+            return backend
+        err("Unknown JSON backend '%s'." % (backend,))
+
+
+def jsonBackend():
+    if _json_backend is None:
+        setJsonBackend()
+    return _json_backend[0]
+
+
+def toJson(data, compact=False):
+    # Indented by two spaces, or without any whitespace when compact.
+    if jsonBackend() == 'orjson' and _orjsonSafe(data):
+        orjson = _json_backend[1]
+        try:
+            return orjson.dumps(
+                data, option=0 if compact else orjson.OPT_INDENT_2).decode(
+                    'utf-8')
+        except TypeError:
+            # Keys other than strings, integers beyond 64 bits and lone
+            # surrogates are left to json.
+            pass
+    if compact:
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    return json.dumps(data, indent=2, ensure_ascii=False)
+
+
+def _orjsonSafe(data):
+    # orjson formats floats which json writes with an exponent differently,
+    # and infinities and NaN as null.  Everything else made of the types
+    # json knows comes out the same, or makes it raise.
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        kind = type(value)
+        if kind is str or kind is int or kind is bool or value is None:
+            continue
+        if kind is dict:
+            stack.extend(value.values())
+        elif kind is list or kind is tuple:
+            stack.extend(value)
+        elif kind is float:
+            if not math.isfinite(value) or 'e' in repr(value):
+                return False
+        else:
+            # orjson encodes some types, dataclasses for instance, which
+            # json doesn't.
+            return False
+    return True
+
+
+def writeJsonStream(f, data, key, items, compact=False):
+    for text in iterJsonStream(data, key, items, compact):
+        f.write(text)
+
+
+def iterJsonStream(data, key, items, compact=False):
+    # Yields toJson(data) with a trailing list under 'key' whose items are
+    # serialized one at a time, producing exactly the same text.
+    head = toJson(data, compact)
+    key = json.dumps(key, ensure_ascii=False)
+    if compact:
+        yield head[:-1] + ',' if data else '{'
+        yield '%s:[' % (key,)
+        sep = ''
+        for item in items:
+            yield sep
+            yield toJson(item, compact=True)
+            sep = ','
+        yield ']}'
+        return
+
+    yield head[:-2] + ',\n' if data else '{\n'
+    yield '  %s: [' % (key,)
+    sep = '\n    '
+    for item in items:
+        yield sep
+        yield toJson(item).replace('\n', '\n    ')
+        sep = ',\n    '
+    yield ']\n}' if sep == '\n    ' else '\n  ]\n}'
+
+
+def placeFile(src, dst, mode='copy'):
+    # Puts a copy of src at dst, linking instead of copying when asked to.
+    # Falls back to a plain copy when the filesystem can't link.
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        if mode == 'hardlink':
+            os.link(src, dst)
+            return mode
+        if mode == 'symlink':
+            os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+            return mode
+        if mode == 'reflink':
+            _reflink(src, dst)
+            return mode
+    except (OSError, ImportError):
+        if mode not in _place_fallbacks:
+            _place_fallbacks.add(mode)
+            warn("Cannot %s media files, falling back to copying." % (mode,))
+    shutil.copy(src, dst)
+    return 'copy'
+
+
+_place_fallbacks = set()
+
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    import fcntl
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        os.remove(dst)
+        raise
+    shutil.copymode(src, dst)
+
+
+def hashFile(fn, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def hashJson(data):
+    return hashlib.sha256(
+        json.dumps(data, ensure_ascii=False,
+                   sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def hashColumn(column):
+    # Hashes the cells one by one instead of the column as one string.
+    # Each cell is prefixed with its length, so that no two columns share
+    # their input.
+    digest = hashlib.sha256(b'%d\0' % (len(column),))
+    for cell in column:
+        data = cell.encode('utf-8')
+        digest.update(b'%d:' % (len(data),))
+        digest.update(data)
+    return digest.hexdigest()
 
 
 def getFilesList(directory, typ='file'):
@@ -52,6 +321,90 @@ def getFilesList(directory, typ='file'):
     return data
 
 
+def getMediaIndex(directory):
+    return frozenset(getFilesList(directory))
+
+
+def getMediaRefs(cells, media_index):
+    # Ordered and deduplicated list of the media files referenced by cells.
+    # A cell holding nothing but a file name also counts as a reference.
+    # The cells are searched joined into one string, which is about three
+    # times faster than searching them one by one for columns of mostly
+    # plain text, but no faster for short cells full of references.  The
+    # pattern can't match the NUL between cells, so no reference spans two
+    # of them; cells with NULs of their own are searched one by one.
+    # benchmarks/mediarefs.py checks this against _getMediaRefsByCell.
+    cells = list(cells)
+    text = MEDIA_REF_SEP.join(cells)
+    if text.count(MEDIA_REF_SEP) != max(len(cells) - 1, 0):
+        return _getMediaRefsByCell(cells, media_index)
+
+    # Alternatives that can't match anywhere in the text only slow the
+    # search down.
+    branches = tuple(
+        branch for char, branch in MEDIA_REF_BRANCHES if char in text)
+    ref_re = _mediaRefRe(branches) if branches else None
+
+    names = dict()
+    bare = [i for i, cell in enumerate(cells) if cell and cell in media_index]
+    if not ref_re:
+        return list(dict.fromkeys(cells[i] for i in bare))
+    if not bare:
+        # Only one of the groups takes part in a match.
+        refs = dict.fromkeys(map(''.join, ref_re.findall(text)))
+        return list(
+            dict.fromkeys(name for name in (
+                _mediaRefName(ref, media_index, names) for ref in refs)
+                          if name is not None))
+
+    found = dict()
+    next_bare = 0
+    index = position = 0
+    for match in ref_re.finditer(text):
+        index += text.count(MEDIA_REF_SEP, position, match.start())
+        position = match.start()
+        while next_bare < len(bare) and bare[next_bare] <= index:
+            found[cells[bare[next_bare]]] = None
+            next_bare += 1
+        name = _mediaRefName(''.join(filter(None, match.groups())),
+                             media_index, names)
+        if name is not None:
+            found[name] = None
+    for i in bare[next_bare:]:
+        found[cells[i]] = None
+    return list(found)
+
+
+def _getMediaRefsByCell(cells, media_index):
+    found = dict()
+    names = dict()
+    for cell in cells:
+        if not cell:
+            continue
+        if cell in media_index:
+            found[cell] = None
+        for match in MEDIA_REF_RE.finditer(cell):
+            name = _mediaRefName(''.join(filter(None, match.groups())),
+                                 media_index, names)
+            if name is not None:
+                found[name] = None
+    return list(found)
+
+
+@lru_cache()
+def _mediaRefRe(branches):
+    return re.compile('|'.join(branches), re.IGNORECASE)
+
+
+def _mediaRefName(ref, media_index, names):
+    if ref not in names:
+        names[ref] = next(
+            (name for name in (ref, html.unescape(ref),
+                               unquote(html.unescape(ref)))
+             if name in media_index), None)
+    return names[ref]
+
+
 def getJsons(directory):
     return [
         getJson(os.path.join(directory, fn)) for fn in getFilesList(directory)
@@ -70,16 +423,9 @@ def getTemplates(directory):
         base, ext = os.path.splitext(fn)
         if ext != '.html':
             continue
-        html = getRaw(os.path.join(directory, fn))
-        lines = html.splitlines()
-        try:
-            idx = lines.index('--')
-        except ValueError:
-            raise RuntimeError(
-                "Incorrect template: %s.  It must consist of two parts divided by '--' on a separate line."
-            )
-        data[base] = dict(qfmt='\n'.join(lines[:idx]),
-                          afmt='\n'.join(lines[idx + 1:]),
+        qfmt, afmt = splitTemplate(getRaw(os.path.join(directory, fn)))
+        data[base] = dict(qfmt=qfmt,
+                          afmt=afmt,
                           name=base,
                           bafmt='',
                           bqfmt='',
@@ -87,6 +433,17 @@ def getTemplates(directory):
     return data
 
 
+def splitTemplate(html):
+    lines = html.splitlines()
+    try:
+        idx = lines.index('--')
+    except ValueError:
+        raise RuntimeError(
+            "Incorrect template: %s.  It must consist of two parts divided by '--' on a separate line."
+        )
+    return '\n'.join(lines[:idx]), '\n'.join(lines[idx + 1:])
+
+
 def getRaw(fn, required=True):
     if not required and not os.path.exists(fn):
         return None
@@ -106,55 +463,351 @@ def getJson(fn, required=True):
     return json.loads(data)
 
 
-def getCsv(fn, required=True):
+def iterJsonObject(f, lazy=(), block_size=1 << 16):
+    # Reads the top-level JSON object in f incrementally, yielding its
+    # (key, value) pairs.  Arrays under the keys in 'lazy' are yielded as
+    # iterators over their items, which are only decoded when reached; the
+    # remainder of such an array is skipped when the next pair is requested.
+    stream = _JsonStream(f, block_size)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key in lazy and stream.peek() == '[':
+            items = stream.items()
+            yield key, items
+            for _ in items:
+                pass
+        else:
+            yield key, stream.value()
+        if stream.expect(',}') == '}':
+            return
+
+
+class _JsonStream:
+    _whitespace = re.compile(r'[ \t\n\r]*')
+    _number_tail = re.compile(r'[0-9.eE+-]*\Z')
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, f, block_size):
+        self._f = f
+        self._block_size = block_size
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _more(self):
+        # Read at least as much as is buffered so that retrying a value
+        # that spans many blocks stays linear.
+        data = self._f.read(max(self._block_size, len(self._buf) - self._pos))
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        self._eof = not data
+        return not self._eof
+
+    def peek(self):
+        while True:
+            self._pos = self._whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._more():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            err("Malformed JSON: expected one of %r but found %r." %
+                (chars, char or 'end of file'))
+        self._pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._more():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next block.
+            if (isinstance(value, (int, float)) and
+                    self._number_tail.match(self._buf, end) and self._more()):
+                continue
+            self._pos = end
+            return value
+
+    def items(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+class CsvLanguage(Mapping):
+    # Read-only view of the columns of one language.  The columns are shared
+    # between all languages, only the field name mapping differs.  So are
+    # the indexes of the columns.
+
+    def __init__(self, columns, fields, indexes=None):
+        self._columns = columns
+        self._fields = fields
+        self._indexes = dict() if indexes is None else indexes
+
+    def __getitem__(self, field):
+        return self._columns[self._fields[field]]
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def rowCount(self):
+        return next((len(column) for column in self._columns
+                     if column is not None), 0)
+
+    def index(self, field):
+        # Row numbers of the cells of a column by value, or by tag for the
+        # 'tags' column.
+        i = self._fields[field]
+        if i not in self._indexes:
+            self._indexes[i] = indexColumn(self._columns[i],
+                                           tags=field == 'tags')
+        return self._indexes[i]
+
+    def select(self, rows, copies):
+        # View of the rows numbered in 'rows'.  The columns are copied into
+        # 'copies', so views of the same list of rows share them.
+        columns = [None] * len(self._columns)
+        for i in set(self._fields.values()):
+            key = (i, id(rows))
+            if key not in copies:
+                column = self._columns[i]
+                copies[key] = (rows, [column[row] for row in rows])
+            columns[i] = copies[key][1]
+        return CsvLanguage(columns, self._fields)
+
+
+def indexColumn(column, tags=False):
+    index = defaultdict(list)
+    if tags:
+        for i, cell in enumerate(column):
+            for tag in set(cell.split(' ')):
+                index[tag].append(i)
+    else:
+        for i, cell in enumerate(column):
+            index[cell].append(i)
+    return dict(index)
+
+
+def getCsv(fn, required=True, chunk_size=10000, index=(), project=None):
     if not required and not os.path.exists(fn):
         return None
 
-    langs = defaultdict(dict)
-    result = defaultdict(lambda: defaultdict(list))
-    with open(fn, newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        header = next(reader)
-        for i, col in enumerate(header):
-            if ':' in col:
-                field, lang = col.rsplit(':', 1)
-                if field == 'guid':
-                    warn('Translating "guid" field doesn\'t make any sense.')
-                langs[lang][field] = i
-            else:
-                langs['default'][col] = i
+    return csvLanguages(*getCsvColumns(fn, chunk_size, project), index=index)
 
-        for lang, cols in langs.items():
-            if lang != 'default':
-                langs[lang].update(langs['default'])
 
-            langs[lang] = cols = dict(
-                reversed(pr) for pr in langs[lang].items())
+def getCsvColumns(fn, chunk_size=10000, project=None):
+    # Returns the columns of a CSV file and the field to column index mapping
+    # of every language, as plain lists and dicts.
+    return csvColumns(*readCsv(fn, chunk_size, project))
 
-        for row in reader:
-            for lang, cols in langs.items():
-                for i, cell in enumerate(row):
-                    if i in cols:
-                        result[lang][cols[i]].append(cell)
 
-    if not result:
+def csvColumns(header, columns):
+    # Columns left out by a projection are None.  They aren't mapped, but
+    # their languages are still listed.
+    langs = defaultdict(dict)
+    for i, col in enumerate(header):
+        field, lang = fieldLang(col)
+        if ':' in col and field == 'guid':
+            warn('Translating "guid" field doesn\'t make any sense.')
+        if columns[i] is None:
+            langs.setdefault(lang, dict())
+        else:
+            langs[lang][field] = i
+
+    loaded = [column for column in columns if column is not None]
+    if not loaded or not loaded[0]:
         # Create one row anyway
-        for lang, cols in langs.items():
-            for i, col in enumerate(cols):
-                result[lang][col].append('')
+        for column in loaded:
+            column.append('')
+
+    return columns, dict(langs)
+
+
+def fieldLang(name):
+    # Splits a column name into its field and language.
+    if ':' in name:
+        return tuple(name.rsplit(':', 1))
+    return name, 'default'
+
+
+def projection(fields, langs=None):
+    # Which columns of the notes to load: those of 'fields', in the default
+    # language and in 'langs', or in every language when it's None.  Kept as
+    # plain lists so that it can be stored and sent to worker processes.
+    return [sorted(fields), sorted(langs) if langs is not None else None]
+
+
+def projectHeader(header, project):
+    # Returns the positions of the columns of 'header' kept by 'project'.
+    if project is None:
+        return list(range(len(header)))
+    fields, langs = set(project[0]), project[1]
+    positions = []
+    for i, name in enumerate(header):
+        field, lang = fieldLang(name)
+        if field in fields and (langs is None or lang == 'default' or
+                                lang in langs):
+            positions.append(i)
+    return positions
+
+
+def readCsv(fn, chunk_size=10000, project=None):
+    # Returns the header and the columns of a CSV file, None for the columns
+    # left out by 'project'.
+    with open(fn, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        return header, rowsToColumns(reader, len(header), chunk_size,
+                                     projectHeader(header, project))
+
+
+def rowsToColumns(rows, width, chunk_size=10000, positions=None):
+    # Transposes the rows into columns a chunk at a time, keeping only the
+    # columns at 'positions'.  Short rows are padded so that every column has
+    # the same length.
+    columns = [None] * width
+    positions = list(range(width)) if positions is None else positions
+    for i in positions:
+        columns[i] = []
+    if not positions:
+        return columns
+    getter = itemgetter(*positions)
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        chunk = [
+            row if len(row) >= width else row + [''] * (width - len(row))
+            for row in chunk
+        ]
+        if len(positions) == width:
+            cells = zip(*chunk)
+        elif len(positions) == 1:
+            cells = [list(map(getter, chunk))]
+        else:
+            cells = zip(*map(getter, chunk))
+        for i, column in zip(positions, cells):
+            columns[i].extend(column)
+    return columns
+
+
+def readCsvFiles(fns, jobs=None, project=None):
+    # Reads several CSV files with readCsv, each in a worker process when
+    # there are cores to spare.
+    jobs = min(len(fns), jobs or os.cpu_count() or 1)
+    if jobs < 2:
+        return [readCsv(fn, project=project) for fn in fns]
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(partial(readCsv, project=project), fns))
+
+
+def getDataFiles(base):
+    # The files holding the notes of a deck set: 'data.csv', the shards in a
+    # 'data' directory in name order, or the 'data.sqlite' note store.
+    fn = os.path.join(base, 'data.csv')
+    directory = os.path.join(base, 'data')
+    store = os.path.join(base, 'data.sqlite')
+    if [os.path.exists(fn),
+            os.path.isdir(directory),
+            os.path.exists(store)].count(True) > 1:
+        err("Found more than one of 'data.csv', 'data' and 'data.sqlite' in '%s'."
+            % (base,))
+    if os.path.exists(store):
+        return [store]
+    if not os.path.isdir(directory):
+        return [fn]
+    shards = [
+        os.path.join(directory, shard)
+        for shard in sorted(getFilesList(directory))
+        if os.path.splitext(shard)[1] == '.csv'
+    ]
+    if not shards:
+        err("No CSV files found in '%s'." % (directory,))
+    return shards
+
+
+def mergeCsvShards(fns, shards):
+    # Concatenates the columns of the shards, the results of readCsv, in the
+    # order given.  Shards must have the same columns, but not necessarily
+    # in the same order, and a guid can only be used in one of them.
+    header = shards[0][0]
+    columns = [[] if column is not None else None for column in shards[0][1]]
+    owners = dict()
+    for fn, (shard_header, shard_columns) in zip(fns, shards):
+        if shard_header != header:
+            if sorted(shard_header) != sorted(header):
+                err("The columns of '%s' don't match those of '%s'." %
+                    (fn, fns[0]))
+            by_name = dict(zip(shard_header, shard_columns))
+            shard_columns = [by_name[name] for name in header]
+        for column, cells in zip(columns, shard_columns):
+            if column is not None:
+                column.extend(cells)
+
+        if 'guid' in header:
+            guids = set(shard_columns[header.index('guid')])
+            guids.discard('')
+            clash = guids.intersection(owners)
+            if clash:
+                guid = min(clash)
+                err("Guid '%s' is used in both '%s' and '%s'.  Run 'index' command."
+                    % (guid, owners[guid], fn))
+            owners.update(dict.fromkeys(guids, fn))
+    return header, columns
+
+
+def csvLanguages(columns, langs, index=()):
+    # The fields named in 'index' are indexed up front in every language.
+    result = dict()
+    indexes = dict()
+    for lang, cols in langs.items():
+        if lang != 'default':
+            cols = dict(langs.get('default', {}), **cols)
+        result[lang] = CsvLanguage(columns, cols, indexes)
+        for field in index:
+            if field in cols:
+                result[lang].index(field)
 
     return result
 
 
 def createGuid():
+    return createGuids(1)[0]
+
+
+def createGuids(count):
     table = GUID_CHARS
-    num = random.randint(0, 2**63)
-    buf = ""
-    while num:
-        mod = num % len(table)
-        num = int((num - mod) / len(table))
-        buf = table[mod] + buf
-    return buf
+    base = len(table)
+    result = []
+    for _ in range(count):
+        num = random.randint(0, 2**63)
+        buf = []
+        while num:
+            num, mod = divmod(num, base)
+            buf.append(table[mod])
+        result.append(''.join(reversed(buf)))
+    return result
 
 
 def createUuid():
@@ -165,76 +818,94 @@ def uuidEncode(uuid, lang):
     if lang == 'default':
         return uuid
     table = '0123456789abcdef'
-    lang_code = sum(ord[c] for c in lang)
+    lang_code = sum(ord(c) for c in lang)
 
-    result = ''
-    for a in uuid:
-        if a == '-':
-            result += '-'
-            continue
-        try:
-            an = table.index(a)
-        except:
-            err("Cannot encode 'uuid': uuid char not found: %s. 'lang' = %s, 'uuid' = %s"
-                % (a, lang, uuid))
-        cn = an + lang_code % len(table)
-        result += table[cn]
-
-    return result
+    invalid = set(uuid) - UUID_CHARS
+    if invalid:
+        err("Cannot encode 'uuid': uuid char not found: %s. 'lang' = %s, 'uuid' = %s"
+            % (min(invalid), lang, uuid))
+    shift = lang_code % len(table)
+    return uuid.translate(str.maketrans(table, table[shift:] + table[:shift]))
 
 
 def guidEncode(guid, uuid):
-    return _guidTransform(guid, uuid, 'encode')
+    return guidEncodeColumn([guid], uuid)[0]
 
 
 def guidDecode(guid, uuid):
-    return _guidTransform(guid, uuid, 'decode')
+    return guidDecodeColumn([guid], uuid)[0]
 
 
-def _guidTransform(guid, uuid, direction='encode'):
-    table = GUID_CHARS
-    i = 0
-    result = ''
-    for b in uuid:
-        cn = 0
-        a = guid[i]
-        try:
-            an = table.index(a)
-        except:
-            err("Cannot encode 'guid': guid char not found: %s.  'guid' = %s, 'uuid' = %s"
-                % (a, guid, uuid))
-        try:
-            bn = table.index(b)
-        except:
-            err("Cannot encode 'guid': guid char not found: %s.  'guid' = %s, 'uuid' = %s"
-                % (b, guid, uuid))
+def guidEncodeColumn(guids, uuid):
+    return _guidTransform(guids, uuid, 'encode')
+
+
+def guidDecodeColumn(guids, uuid):
+    return _guidTransform(guids, uuid, 'decode')
+
+
+def guidInvertColumn(guids, uuid):
+    # Returns the data.csv guids which guidDecodeColumn, and so a build,
+    # turns into 'guids'.  Unlike guidEncodeColumn this really undoes it.
+    return _guidTransform(guids, uuid, 'invert')
 
-        if dir == 'encode':
-            cn = an - bn
-        else:
-            cn = an + bn
 
-        if cn >= len(table):
-            cn = cn % len(table)
-        elif cn < 0:
-            cn = len(table) + cn
+def _guidTransform(guids, uuid, direction='encode'):
+    table = GUID_CHARS
+    index = GUID_INDEX
+    size = len(table)
 
-        result += table[cn]
-        i = (i + 1) % len(guid)
+    # FIXME: The original compared the builtin 'dir' rather than 'direction'
+    # here, so both directions add the uuid.  Kept that way so that existing
+    # data.csv files keep building to the same guids.
+    try:
+        offsets = [index[b] for b in uuid]
+    except KeyError as e:
+        err("Cannot encode 'guid': guid char not found: %s.  'uuid' = %s" %
+            (e.args[0], uuid))
 
     # FIXME: Original code wrapped around and overwrote beginning if len(guid) < len(uuid)
     # Is this just a makeshift hash?  I guess we check that the generated hashes are unique
     # afterward.  I guess you roll the dice when you reindex.  GUID seems to be a misnomer.
 
-    rln = len(result)
-    gln = len(guid)
-    if rln < gln:
-        return result
-    if rln % gln == 0:
-        return result[-gln:]
-
-    split = (int(rln / gln)) * gln
-    return result[split:] + result[-gln:split]
+    # Each result is the tail of the uuid-length transform, rotated so that
+    # the last partial lap over the guid comes first.  Which uuid positions
+    # end up where only depends on the length of the guid.
+    rln = len(offsets)
+    layouts = dict()
+    result = []
+    for guid in guids:
+        gln = len(guid)
+        if gln not in layouts:
+            if rln < gln:
+                positions = list(range(rln))
+            elif rln % gln == 0:
+                positions = list(range(rln - gln, rln))
+            else:
+                split = (rln // gln) * gln
+                positions = list(range(split, rln)) + list(
+                    range(rln - gln, split))
+            layouts[gln] = [(k % gln, offsets[k]) for k in positions]
+        try:
+            if direction != 'invert':
+                result.append(''.join([
+                    table[(index[guid[i]] + bn) % size]
+                    for i, bn in layouts[gln]
+                ]))
+            elif rln < gln:
+                err("Cannot invert 'guid': it is longer than the uuid.  'guid' = %s, 'uuid' = %s"
+                    % (guid, uuid))
+            else:
+                # Every guid position is taken exactly once, by character
+                # j of the result.
+                chars = [''] * gln
+                for j, (i, bn) in enumerate(layouts[gln]):
+                    chars[i] = table[(index[guid[j]] - bn) % size]
+                result.append(''.join(chars))
+        except KeyError as e:
+            err("Cannot encode 'guid': guid char not found: %s.  'guid' = %s, 'uuid' = %s"
+                % (e.args[0], guid, uuid))
+    return result
 
 
 def isDirEmpty(directory):
@@ -257,12 +928,7 @@ def filenameToDeck(filename):
 
 
 def ensureFilename(filename):
-    allowed_chars = 'abcdefghijklmnopqrstuvwxyz' + 'ABCDEFGHIJKLMNOPQRSTUVWXYZ' + '0123456789' + "$-_ "
-    result = ''
-    for char in filename:
-        result += char if char in allowed_chars else '-'
-
-    return result
+    return FILENAME_DISALLOWED_RE.sub('-', filename)
 
 
 def checkFieldName(name):
@@ -0,0 +1,99 @@
+import ankidmpy.builder as builder
+import ankidmpy.util as util
+import os.path
+import time
+
+JSON_SOURCES = ('deck.json', 'config.json', 'model.json', 'desc.html',
+                'style.css')
+SOURCE_DIRS = ('templates', 'media', 'decks', 'data')
+
+
+def watch(decks,
+          src_dir,
+          build_dir,
+          lang,
+          interval=0.5,
+          jobs=1,
+          media_mode='copy',
+          media_store=False,
+          io_threads=builder.IO_THREADS,
+          io_queue=builder.IO_QUEUE_DEPTH,
+          archive=None,
+          where=None,
+          compact=False):
+    build_dir = build_dir or 'build'
+    deck_set = None
+    stale = set()
+    snapshot = _snapshot(src_dir)
+
+    util.msg("Watching '%s' for changes.  Press Ctrl-C to stop." % (src_dir,))
+    changed = True
+    try:
+        while True:
+            if changed:
+                start = time.perf_counter()
+                try:
+                    if deck_set is None:
+                        deck_set = builder.DeckSet(src_dir,
+                                                   decks,
+                                                   lang,
+                                                   where,
+                                                   cache='write')
+                    else:
+                        deck_set.reload(stale)
+                    stale = set()
+                    deck_set.write(build_dir,
+                                   jobs=jobs,
+                                   media_mode=media_mode,
+                                   media_store=media_store,
+                                   io_threads=io_threads,
+                                   io_queue=io_queue,
+                                   archive=archive,
+                                   compact=compact,
+                                   verbose=False)
+                    util.msg("Done in %.2fs." % (time.perf_counter() - start,))
+                except (RuntimeError, ValueError, OSError) as e:
+                    # Sources that failed to load are read again after the
+                    # next change, which will hopefully fix them.
+                    util.warn("Build failed: %s" % (e,))
+
+            time.sleep(interval)
+            current = _snapshot(src_dir)
+            changed = set(current.items()) ^ set(snapshot.items())
+            snapshot = current
+
+            stale.update(_sourceGroup(path) for path, _ in changed)
+    except KeyboardInterrupt:
+        pass
+
+
+def _snapshot(src_dir):
+    # Only the files the build reads are watched, so the build directory and
+    # anything else kept next to the sources is ignored.
+    snapshot = dict()
+    for fn in JSON_SOURCES + ('data.csv', 'data.sqlite'):
+        _stat(snapshot, src_dir, fn)
+    for dirname in SOURCE_DIRS:
+        for root, _, files in os.walk(os.path.join(src_dir, dirname)):
+            for fn in files:
+                _stat(snapshot, src_dir,
+                      os.path.relpath(os.path.join(root, fn), src_dir))
+    return snapshot
+
+
+def _stat(snapshot, src_dir, fn):
+    try:
+        st = os.stat(os.path.join(src_dir, fn))
+    except OSError:
+        return
+    snapshot[fn] = (st.st_mtime_ns, st.st_size)
+
+
+def _sourceGroup(path):
+    top = path.split(os.sep, 1)[0]
+    if top in ('data.csv', 'data.sqlite'):
+        return 'data'
+    if top in JSON_SOURCES:
+        return 'json'
+    return top
+